@@ -0,0 +1,188 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import warnings
+
+import numpy as np
+
+warnings.simplefilter("ignore", FutureWarning)
+warnings.simplefilter("ignore", DeprecationWarning)
+
+import main
+
+MAX_FLOORS = 30
+
+
+class TrackingPolicy(main.DescendPolicy):
+    #plays like DescendPolicy and tallies turns, damage taken and progression for each floor
+    def __init__(self):
+        super().__init__()
+        self.turns = np.zeros(MAX_FLOORS, dtype=np.int32)
+        self.damage = np.zeros(MAX_FLOORS, dtype=np.int32)
+        self.level = np.zeros(MAX_FLOORS, dtype=np.int32)
+        self.xp = np.zeros(MAX_FLOORS, dtype=np.int32)
+        self.floor = None
+        self.hp = None
+
+    def observe(self, engine):
+        fighter = engine.player.fighter
+        if self.hp is not None and fighter.hp < self.hp:
+            self.damage[self.floor] += self.hp - fighter.hp
+        self.hp = fighter.hp
+
+    def get_action(self, engine):
+        self.observe(engine)
+        floor = min(engine.game_world.current_floor, MAX_FLOORS) - 1
+        if floor != self.floor:
+            self.floor = floor
+            self.level[floor] = engine.player.level.current_level
+            self.xp[floor] = engine.player.level.current_xp
+        self.turns[floor] += 1
+        return super().get_action(engine)
+
+    def on_impossible(self, engine, action):
+        #run_headless doesn't count it as a turn either
+        self.turns[self.floor] -= 1
+        super().on_impossible(engine, action)
+
+
+def load_packs(directory):
+    #forked workers already have the parent's packs, spawned ones start from a fresh import
+    if not main.LOADED_PACKS:
+        main.load_content_packs(directory)
+
+
+def simulate(job):
+    seed, max_turns = job
+    policy = TrackingPolicy()
+    engine, turns = main.run_headless(policy, max_turns=max_turns, seed=seed)
+    policy.observe(engine)
+    return {
+        "seed": seed,
+        "deepest": min(engine.game_world.current_floor, MAX_FLOORS),
+        "died": not engine.player.isAlive,
+        "outcome": main.run_status(engine, turns, max_turns),
+        "turns": turns,
+        "final_level": engine.player.level.current_level,
+        "turns_per_floor": policy.turns,
+        "damage_per_floor": policy.damage,
+        "level_per_floor": policy.level,
+        "xp_per_floor": policy.xp,
+    }
+
+
+def collect(results):
+    results = sorted(results, key=lambda result: result["seed"])
+    return {
+        "seed": np.array([result["seed"] for result in results]),
+        "deepest": np.array([result["deepest"] for result in results]),
+        "died": np.array([result["died"] for result in results]),
+        "outcome": np.array([result["outcome"] for result in results]),
+        "turns": np.array([result["turns"] for result in results]),
+        "final_level": np.array([result["final_level"] for result in results]),
+        "turns_per_floor": np.stack([result["turns_per_floor"] for result in results]),
+        "damage_per_floor": np.stack([result["damage_per_floor"] for result in results]),
+        "level_per_floor": np.stack([result["level_per_floor"] for result in results]),
+        "xp_per_floor": np.stack([result["xp_per_floor"] for result in results]),
+    }
+
+
+def summarize_cut_short(arrays, outcome):
+    #runs that ended still alive, at the turn limit or with the bot stalled, are kept out of the per-floor curves
+    runs = arrays["outcome"] == outcome
+    if not runs.any():
+        return {"games": 0}
+    return {
+        "games": int(runs.sum()),
+        "mean_deepest": float(arrays["deepest"][runs].mean()),
+        "median_turns": float(np.median(arrays["turns"][runs])),
+        "seeds": arrays["seed"][runs].tolist(),
+    }
+
+
+def summarize(arrays):
+    cut_short = {outcome: summarize_cut_short(arrays, outcome) for outcome in ("alive", "stalled")}
+    games = len(arrays["seed"])
+    arrays = {name: values[arrays["outcome"] == "dead"] for name, values in arrays.items()}
+    floors = np.arange(1, MAX_FLOORS + 1)
+    reached = arrays["deepest"][:, None] >= floors[None, :]
+    died_on = arrays["died"][:, None] & (arrays["deepest"][:, None] == floors[None, :])
+    rows = []
+    for i, floor_number in enumerate(floors):
+        visitors = reached[:, i]
+        count = int(visitors.sum())
+        if count == 0:
+            break
+        rows.append({
+            "floor": int(floor_number),
+            "reached": count / len(visitors),
+            "died_here": int(died_on[:, i].sum()),
+            "median_turns": float(np.median(arrays["turns_per_floor"][visitors, i])),
+            "mean_damage": float(arrays["damage_per_floor"][visitors, i].mean()),
+            "mean_level_on_arrival": float(arrays["level_per_floor"][visitors, i].mean()),
+            "mean_xp_on_arrival": float(arrays["xp_per_floor"][visitors, i].mean()),
+        })
+    finished = len(arrays["seed"]) > 0
+    return {
+        "games": games,
+        "deaths": int(arrays["died"].sum()),
+        "mean_deepest": float(arrays["deepest"].mean()) if finished else None,
+        "mean_turns": float(arrays["turns"].mean()) if finished else None,
+        "mean_final_level": float(arrays["final_level"].mean()) if finished else None,
+        "turn_limit": cut_short["alive"],
+        "stalled": cut_short["stalled"],
+        "floors": rows,
+    }
+
+
+def print_summary(summary, elapsed):
+    print(f"{summary['games']} games in {elapsed:.1f}s, {summary['deaths']} deaths")
+    for name, label in (("turn_limit", "hit the turn limit"), ("stalled", "stalled")):
+        runs = summary[name]
+        if runs["games"]:
+            print(f"{runs['games']} {label} (mean deepest floor {runs['mean_deepest']:.2f}, median {runs['median_turns']:.0f} turns), left out below")
+    if not summary["deaths"]:
+        return
+    print(f"over the {summary['deaths']} deaths: mean deepest floor {summary['mean_deepest']:.2f}, mean final level {summary['mean_final_level']:.2f}")
+    print(f"{'floor':>5} {'reached':>8} {'died':>6} {'turns p50':>10} {'damage':>8} {'level':>6} {'xp':>8}")
+    for row in summary["floors"]:
+        print(f"{row['floor']:>5} {row['reached']:>8.1%} {row['died_here']:>6} {row['median_turns']:>10.0f} {row['mean_damage']:>8.1f} {row['mean_level_on_arrival']:>6.2f} {row['mean_xp_on_arrival']:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate many headless games to check item, monster and XP balance.")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=5000, help="turn limit per game")
+    parser.add_argument("--seed", type=int, default=0, help="first seed, game i uses seed + i")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default="balance_report.json")
+    parser.add_argument("--arrays", metavar="FILE", help="also save the per-game arrays to FILE as .npz")
+    parser.add_argument("--packs", metavar="DIR", default=main.CONTENT_DIR, help="content packs to play with (default: packs/ next to main.py)")
+    args = parser.parse_args()
+    try:
+        packs = main.load_content_packs(args.packs)
+    except main.ContentError as exc:
+        raise SystemExit(f"Could not load content packs: {exc}")
+    jobs = [(args.seed + game, args.turns) for game in range(args.games)]
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.workers, initializer=load_packs, initargs=(args.packs,)) as pool:
+        results = list(pool.imap_unordered(simulate, jobs, chunksize=max(1, len(jobs) // (args.workers * 16))))
+    elapsed = time.perf_counter() - start
+    arrays = collect(results)
+    summary = summarize(arrays)
+    summary["meta"] = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seed": args.seed,
+        "turn_limit": args.turns,
+        "workers": args.workers,
+        "packs": packs,
+        "seconds": elapsed,
+    }
+    print_summary(summary, elapsed)
+    with open(args.output, "w") as f:
+        json.dump(summary, f, indent=2)
+    if args.arrays:
+        np.savez_compressed(args.arrays, **arrays)
+    print(f"Wrote {args.output}")
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import pickle
+import warnings
+
+import numpy as np
+
+warnings.simplefilter("ignore", FutureWarning)
+warnings.simplefilter("ignore", DeprecationWarning)
+
+import tcod
+import main
+
+MAP_SIZES = [(80, 43), (200, 200), (500, 500), (1000, 1000)]
+ACTOR_COUNTS = [10, 100, 1000, 10000]
+DEPTHS = [1, 5, 10]
+QUICK_MAP_SIZES = [(80, 43), (200, 200)]
+QUICK_ACTOR_COUNTS = [10, 100, 1000]
+
+
+def rooms_for(width, height):
+    #keep the room density of the default 80x43 map
+    return max(30, 30 * width * height // (80 * 43))
+
+
+def make_engine(width, height, depth=1, seed=0):
+    random.seed(seed)
+    engine = main.new_game(map_width=width, map_height=height, max_rooms=rooms_for(width, height), seed=seed)
+    if depth > 1:
+        engine.game_world.current_floor = depth - 1
+        engine.game_world.generate_floor()
+        engine.update_fov()
+    return engine
+
+
+def add_actors(engine, count, seed=0):
+    rng = random.Random(seed)
+    game_map = engine.game_map
+    xs, ys = np.nonzero(game_map.tiles["walkable"])
+    spawned = 0
+    for i in rng.sample(range(len(xs)), min(count, len(xs))):
+        x, y = int(xs[i]), int(ys[i])
+        if not game_map.get_entities_at_location(x, y):
+            main.vampire.spawn(game_map, x, y)
+            spawned += 1
+    return spawned
+
+
+def timeit(func, repeats, setup=None):
+    samples = []
+    for _ in range(repeats):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def record(results, name, params, samples):
+    entry = {
+        "name": name,
+        "params": params,
+        "repeats": len(samples),
+        "min_s": min(samples),
+        "median_s": statistics.median(samples),
+        "mean_s": statistics.fmean(samples),
+    }
+    results.append(entry)
+    print(f"{name:<20} {json.dumps(params):<50} median {entry['median_s'] * 1000:10.3f} ms")
+
+
+def bench_generate_dungeon(results, sizes, depths, repeats, seed):
+    for width, height in sizes:
+        for depth in depths:
+            engine = make_engine(80, 43, seed=seed)
+            engine.game_world.map_width = width
+            engine.game_world.map_height = height
+            engine.game_world.max_rooms = rooms_for(width, height)
+
+            def run():
+                engine.game_world.build_floor(depth)
+
+            random.seed(seed)
+            record(results, "generate_dungeon", {"width": width, "height": height, "depth": depth}, timeit(run, repeats))
+
+
+def bench_update_fov(results, sizes, repeats, seed):
+    for width, height in sizes:
+        engine = make_engine(width, height, seed=seed)
+        game_map = engine.game_map
+        player = engine.player
+        #step back and forth so every call recomputes instead of hitting the unchanged-position shortcut
+        steps = [(player.x, player.y)] + [(player.x + dx, player.y + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)) if game_map.tiles["walkable"][player.x + dx, player.y + dy]][:1]
+
+        def run():
+            steps.reverse()
+            game_map.move_entity(player, *steps[0])
+            engine.update_fov()
+
+        record(results, "update_fov", {"width": width, "height": height}, timeit(run, repeats))
+
+
+def bench_render(results, sizes, repeats, seed):
+    for width, height in sizes:
+        engine = make_engine(width, height, seed=seed)
+        console = tcod.console.Console(width, height, order="F")
+        record(results, "game_map_render", {"width": width, "height": height}, timeit(lambda: engine.game_map.render(console), repeats))
+        screen = tcod.console.Console(80, 50, order="F")
+        record(results, "viewport_render", {"width": width, "height": height}, timeit(lambda: engine.render(screen), repeats))
+
+
+def bench_enemy_turns(results, counts, repeats, seed):
+    for count in counts:
+        side = max(80, int((count * 40) ** 0.5))
+        engine = make_engine(side, side, seed=seed)
+        spawned = add_actors(engine, count, seed)
+        record(results, "handle_enemy_turns", {"actors": spawned, "width": side, "height": side}, timeit(engine.handle_enemy_turns, repeats))
+
+
+def bench_chase(results, sizes, repeats, seed):
+    #one monster in view chasing the player: every turn it moves, so the shared flow field is rebuilt
+    for width, height in sizes:
+        engine = make_engine(width, height, seed=seed)
+        engine.update_fov()
+        game_map = engine.game_map
+        player = engine.player
+        start = None
+        for distance in range(main.FOV_RADIUS - 2, 2, -1):
+            for dx, dy in ((distance, 0), (-distance, 0), (0, distance), (0, -distance), (distance, distance), (-distance, -distance), (distance, -distance), (-distance, distance)):
+                x, y = player.x + dx, player.y + dy
+                if game_map.in_bounds(x, y) and game_map.visible[x, y] and game_map.tiles["walkable"][x, y] and not game_map.get_entities_at_location(x, y):
+                    start = (x, y)
+                    break
+            if start:
+                break
+        if start is None:
+            continue
+        monster = main.vampire.spawn(game_map, *start)
+
+        def reset():
+            game_map.move_entity(monster, *start)
+            monster.ai.path = []
+
+        record(results, "enemy_chase", {"width": width, "height": height}, timeit(lambda _: engine.handle_enemy_turns(), repeats, setup=reset))
+
+
+def nearest_by_loop(game_map, consumer, max_distance):
+    #the loop ActorStore.nearest replaced, kept as the reference its answers are checked against
+    target = None
+    closest_distance = max_distance
+    for actor in game_map.actors:
+        if actor is not consumer and game_map.visible[actor.x, actor.y]:
+            distance = consumer.distance(actor.x, actor.y)
+            if distance < closest_distance:
+                target, closest_distance = actor, distance
+    return target
+
+
+def bench_nearest(results, counts, repeats, seed):
+    #the Arcane Blast target query from every actor's tile, checked against the loop before it is timed
+    for count in counts:
+        side = max(80, int((count * 40) ** 0.5))
+        engine = make_engine(side, side, seed=seed)
+        spawned = add_actors(engine, count, seed)
+        game_map = engine.game_map
+        game_map.visible[:] = True
+        store = game_map.actor_store
+        consumers = [engine.player] + list(game_map.actors)[:100]
+        for consumer in consumers:
+            for max_distance in (1, 2, 6, side):
+                expected = nearest_by_loop(game_map, consumer, max_distance)
+                found = store.nearest(consumer.x, consumer.y, max_distance, visible=game_map.visible, exclude=consumer)
+                if found is not expected:
+                    sys.exit(f"ActorStore.nearest from ({consumer.x}, {consumer.y}) within {max_distance} gave {found and found.name} at {found and (found.x, found.y)}, the loop {expected and expected.name} at {expected and (expected.x, expected.y)}")
+
+        def run():
+            for consumer in consumers:
+                store.nearest(consumer.x, consumer.y, 6, visible=game_map.visible, exclude=consumer)
+
+        record(results, "actor_nearest", {"actors": spawned, "queries": len(consumers), "width": side, "height": side}, timeit(run, repeats))
+
+
+def bench_spawn(results, counts, repeats, seed):
+    for count in counts:
+        side = max(80, int((count * 40) ** 0.5))
+        samples = timeit(lambda engine: add_actors(engine, count, seed), repeats, setup=lambda: make_engine(side, side, seed=seed))
+        record(results, "entity_spawn", {"actors": count, "width": side, "height": side}, samples)
+
+
+def bench_save_load(results, sizes, repeats, seed):
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.sav")
+        for width, height in sizes:
+            engine = make_engine(width, height, seed=seed)
+            record(results, "save_as", {"width": width, "height": height}, timeit(lambda: engine.save_as(filename), repeats))
+            record(results, "load_game", {"width": width, "height": height, "bytes": os.path.getsize(filename)}, timeit(lambda: main.load_game(filename), repeats))
+
+
+def bench_memory(results, count):
+    #bytes held per live object, and per object once pickled, for the kinds a big floor is made of
+    kinds = {
+        "actor": lambda: main.prefab_for(main.vampire).build(),
+        "item": lambda: main.prefab_for(main.health_potion).build(),
+        "action": lambda: main.BumpAction(None, 1, 0),
+        "message": lambda: main.Message("The Vampire attacks Player for 1 hit points.", main.enemy_atk),
+    }
+    for kind, make in kinds.items():
+        make()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [make() for _ in range(count)]
+        held = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        pickled = len(pickle.dumps(objects, protocol=5))
+        entry = {
+            "name": "memory",
+            "params": {"kind": kind, "count": count},
+            "bytes_per_object": held / count,
+            "pickled_bytes_per_object": pickled / count,
+        }
+        results.append(entry)
+        print(f"{'memory':<20} {json.dumps(entry['params']):<50} {entry['bytes_per_object']:8.0f} B/object, {entry['pickled_bytes_per_object']:6.0f} B pickled")
+
+
+def bench_startup(results, repeats):
+    #a fresh interpreter per sample, timed from launch to the first main menu frame (drawn offscreen) and for the whole process
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    to_menu = []
+    process = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-W", "ignore", script, "--headless", "--startup-check"], capture_output=True, text=True, check=False).stdout
+        process.append(time.perf_counter() - start)
+        to_menu.append(int(output.split()[1]) / 1000)
+    record(results, "startup_to_menu", {"budget_s": main.STARTUP_BUDGET}, to_menu)
+    record(results, "startup_process", {}, process)
+
+
+BENCHMARKS = ["generate_dungeon", "update_fov", "render", "enemy_turns", "chase", "nearest", "spawn", "save_load", "memory", "startup"]
+
+
+def run(args):
+    sizes = QUICK_MAP_SIZES if args.quick else MAP_SIZES
+    counts = QUICK_ACTOR_COUNTS if args.quick else ACTOR_COUNTS
+    depths = DEPTHS
+    selected = args.only or BENCHMARKS
+    results = []
+    if "generate_dungeon" in selected:
+        bench_generate_dungeon(results, sizes, depths, args.repeats, args.seed)
+    if "update_fov" in selected:
+        bench_update_fov(results, sizes, args.repeats, args.seed)
+    if "render" in selected:
+        bench_render(results, sizes, args.repeats, args.seed)
+    if "enemy_turns" in selected:
+        bench_enemy_turns(results, counts, args.repeats, args.seed)
+    if "chase" in selected:
+        bench_chase(results, sizes, args.repeats, args.seed)
+    if "nearest" in selected:
+        bench_nearest(results, counts, args.repeats, args.seed)
+    if "spawn" in selected:
+        bench_spawn(results, counts, args.repeats, args.seed)
+    if "save_load" in selected:
+        bench_save_load(results, sizes, args.repeats, args.seed)
+    if "memory" in selected:
+        bench_memory(results, 10000)
+    if "startup" in selected:
+        bench_startup(results, args.repeats)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the game's hot paths on a fixed seed.")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quick", action="store_true", help="only run the smaller map sizes and actor counts")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS)
+    args = parser.parse_args()
+    results = run(args)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "tcod": tcod.__version__,
+            "seed": args.seed,
+            "repeats": args.repeats,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
@@ -1,3 +1,6 @@
+import time
+#taken before tcod and numpy are imported so startup figures include them
+LAUNCH_TIME = time.perf_counter()
 import tcod
 import tcod.event
 from typing import Optional
@@ -7,37 +10,64 @@ from typing import List, Reversible, Union
 from typing import Callable, Dict, Iterator
 from tcod.context import Context
 from tcod.console import Console
+from tcod import libtcodpy
 import numpy as np
 import random
 from tcod.map import compute_fov
-import copy
 from enum import auto, Enum
 import textwrap
+from collections import deque, OrderedDict
 import traceback
 import math
-import lzma
+import zlib
 import pickle
+import json
+import struct
+import threading
 import os
+import sys
+import io
+import functools
+import bisect
+import itertools
+import contextlib
 
 
-def main():
+def main(record_path=None, startup_check=False):
     screen_width = 80
     screen_height = 50
     #tileset = tcod.tileset.load_tilesheet("./dejavu10x10_gs_tc.png", 32, 8, tcod.tileset.CHARMAP_TCOD)  tileset=tileset,
-    player = copy.deepcopy(player_gen)
 
-    handler = MainMenu()
+    handler = MainMenu(record_path=record_path)
+    startup = None
 
     with tcod.context.new_terminal(screen_width, screen_height, title="Compiler Game", vsync=True,) as context:
-        root_console = tcod.Console(screen_width, screen_height, order="F")
+        root_console = Console(screen_width, screen_height, order="F")
         try:
             while True:
-                root_console.clear()
-                handler.on_render(console=root_console)
-                context.present(root_console)
+                if screen_dirty.take():
+                    root_console.clear()
+                    with profiler.timer("frame"):
+                        handler.on_render(console=root_console)
+                    if profiler.overlay:
+                        profiler.render(root_console)
+                    context.present(root_console)
+                    if startup is None:
+                        startup = time.perf_counter() - LAUNCH_TIME
+                        profiler.add("startup", startup)
+                        if startup_check:
+                            return startup
                 try:
-                    for event in tcod.event.wait():
+                    for event in coalesce_events(tcod.event.wait()):
                         context.convert_event(event)
+                        if not isinstance(event, (tcod.event.MouseMotion, tcod.event.KeyUp)):
+                            #key presses, clicks and window events can change anything, mouse motion only the hover text
+                            screen_dirty.mark()
+                        message = profiler.handle_hotkey(event)
+                        if message:
+                            if isinstance(handler, EventHandler):
+                                handler.engine.message_log.add_message(message)
+                            continue
                         handler = handler.handle_events(event)
                 except Exception:
                     traceback.print_exc()
@@ -52,20 +82,26 @@ def main():
             save_game(handler, "savegame.sav")
             raise
 
-def save_game(handler, filename):
-    if isinstance(handler, EventHandler):
-        handler.engine.save_as(filename)
-        print("Game saved.")
+STARTUP_BUDGET = 0.5
 
-def new_game():
-    map_width = 80
-    map_height = 43
+def offscreen_startup():
+    #launch to the first main menu frame, drawn to a console instead of a window
+    console = Console(80, 50, order="F")
+    MainMenu().on_render(console=console)
+    startup = time.perf_counter() - LAUNCH_TIME
+    profiler.add("startup", startup)
+    return startup
 
-    room_max_size = 10
-    room_min_size = 6
-    max_rooms = 30
+def check_startup(startup):
+    print(f"startup {startup * 1000:.0f} ms, budget {STARTUP_BUDGET * 1000:.0f} ms")
+    return 0 if startup <= STARTUP_BUDGET else 1
+
+def save_game(handler, filename):
+    if isinstance(handler, EventHandler):
+        handler.engine.save_as(filename, background=True, on_saved=lambda: print("Game saved."))
 
-    player = copy.deepcopy(player_gen)
+def new_game(map_width=80, map_height=43, room_min_size=6, room_max_size=10, max_rooms=30, seed=None, pregenerate=False):
+    player = prefab_for(player_gen).build()
 
     engine = Engine(player=player)
     engine.game_world = GameWorld(
@@ -75,12 +111,14 @@ def new_game():
         room_max_size=room_max_size,
         map_width=map_width,
         map_height=map_height,
+        seed=seed,
+        pregenerate=pregenerate,
     )
     engine.game_world.generate_floor()
     engine.update_fov()
     engine.message_log.add_message("Welcome to yet another dungeon.", welcome_text)
-    dag = copy.deepcopy(dagger)
-    l_armor = copy.deepcopy(leather_armor)
+    dag = prefab_for(dagger).build()
+    l_armor = prefab_for(leather_armor).build()
 
     dag.parent = player.inventory
     l_armor.parent = player.inventory
@@ -92,18 +130,554 @@ def new_game():
     player.equipment.toggle_equip(l_armor, add_message=False)
     return engine
 
+SAVE_MAGIC = b"DCRYPTSV"
+SAVE_VERSION = 1
+
+def lzma_compress(data):
+    #lzma is only imported once a save asks for it
+    import lzma
+    return lzma.compress(data)
+
+def lzma_decompress(data):
+    import lzma
+    return lzma.decompress(data)
+
+SAVE_CODECS = {
+    "none": (bytes, bytes),
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma_compress, lzma_decompress),
+}
+
+def write_save(engine, filename, codec="zlib", background=False, on_saved=None):
+    #the engine is pickled right away; compressing and writing the sections can happen on a worker thread
+    compress = SAVE_CODECS[codec][0]
+    buffers = []
+    body = pickle.dumps(engine, protocol=5, buffer_callback=buffers.append)
+    sections = [body] + [bytes(buffer.raw()) if background else buffer.raw() for buffer in buffers]
+    header = {
+        "version": SAVE_VERSION,
+        "codec": codec,
+        "floor": engine.game_world.current_floor,
+        "level": engine.player.level.current_level,
+        "hp": engine.player.fighter.hp,
+        "max_hp": engine.player.fighter.max_hp,
+        "saved_at": time.time(),
+        "packs": list(LOADED_PACKS),
+        "spawn_tables": spawn_tables_digest(),
+    }
+
+    def finish():
+        chunks = [compress(section) for section in sections]
+        header["sections"] = [len(chunk) for chunk in chunks]
+        header_bytes = json.dumps(header).encode()
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "wb") as f:
+            f.write(SAVE_MAGIC)
+            f.write(struct.pack("<I", len(header_bytes)))
+            f.write(header_bytes)
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp_filename, filename)
+        if on_saved:
+            on_saved()
+
+    if background:
+        thread = threading.Thread(target=finish, name="save-writer")
+        thread.start()
+        return thread
+    finish()
+    return None
+
+def read_save_header(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(SAVE_MAGIC)) != SAVE_MAGIC:
+            return None
+        (header_length,) = struct.unpack("<I", f.read(4))
+        return json.loads(f.read(header_length))
+
+def describe_save(filename):
+    try:
+        header = read_save_header(filename)
+    except (OSError, ValueError):
+        return ""
+    if header is None:
+        return ""
+    return f"Floor {header['floor']}, level {header['level']}, HP {header['hp']}/{header['max_hp']}"
+
+def check_save_content(header):
+    #archived floors are rebuilt from the spawn tables, so they have to match the ones the save was made with
+    if header.get("packs", []) != LOADED_PACKS:
+        raise ContentError(f"this save needs content packs {header.get('packs', [])}, loaded {LOADED_PACKS}")
+    if header.get("spawn_tables", spawn_tables_digest()) != spawn_tables_digest():
+        raise ContentError("this save was made with different versions of the content packs")
+
 def load_game(filename):
     with open(filename, "rb") as f:
-        engine = pickle.loads(lzma.decompress(f.read()))
+        data = f.read()
+    if data.startswith(SAVE_MAGIC):
+        offset = len(SAVE_MAGIC)
+        (header_length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        header = json.loads(data[offset:offset + header_length])
+        offset += header_length
+        check_save_content(header)
+        decompress = SAVE_CODECS[header["codec"]][1]
+        sections = []
+        for size in header["sections"]:
+            sections.append(bytearray(decompress(data[offset:offset + size])))
+            offset += size
+        engine = pickle.loads(sections[0], buffers=sections[1:])
+    else:
+        engine = pickle.loads(lzma_decompress(data))
+        engine.game_map.rebuild_index()
     assert isinstance(engine, Engine)
     return engine
 
+class ProfileTimer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+
+NULL_TIMER = contextlib.nullcontext()
+
+class Profiler:
+    #named timers with a rolling window of samples each, every timer is a no-op until enabled
+    def __init__(self, window=1000):
+        self.enabled = False
+        self.overlay = False
+        self.window = window
+        self.samples = {}
+        self.capture = None
+
+    def add(self, name, seconds):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples.setdefault(name, deque(maxlen=self.window))
+        samples.append(seconds)
+
+    def timer(self, *name):
+        if not self.enabled:
+            return NULL_TIMER
+        return ProfileTimer(self, ".".join(name))
+
+    def stats(self):
+        rows = []
+        for name, samples in sorted(self.samples.items()):
+            milliseconds = np.array(samples) * 1000
+            p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+            rows.append((name, len(milliseconds), p50, p95, p99, milliseconds.max()))
+        return rows
+
+    def report(self):
+        lines = [f"{'timer':<24} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for name, count, p50, p95, p99, worst in self.stats():
+            lines.append(f"{name:<24} {count:>6} {p50:>9.3f} {p95:>9.3f} {p99:>9.3f} {worst:>9.3f}")
+        return "\n".join(lines)
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        if self.overlay:
+            self.enabled = True
+
+    def toggle_capture(self):
+        if self.capture is None:
+            import cProfile
+            self.capture = cProfile.Profile()
+            self.capture.enable()
+            return "Profiling started."
+        self.capture.disable()
+        filename = time.strftime("profile-%Y%m%d-%H%M%S.prof")
+        self.capture.dump_stats(filename)
+        self.capture = None
+        return f"Profile written to {filename}."
+
+    def handle_hotkey(self, event):
+        #F3 shows the timers, F4 starts and stops a cProfile capture; returns a message, or None if the key isn't ours
+        if not isinstance(event, tcod.event.KeyDown):
+            return None
+        if event.sym == tcod.event.KeySym.F3:
+            self.toggle_overlay()
+            return "Profiler overlay on." if self.overlay else "Profiler overlay off."
+        if event.sym == tcod.event.KeySym.F4:
+            return self.toggle_capture()
+        return None
+
+    def render(self, console):
+        rows = self.stats()
+        width = 50
+        x = console.width - width
+        console.draw_frame(x=x, y=0, width=width, height=len(rows) + 3, title="Profiler (ms)", clear=True, fg=(255, 255, 255), bg=(0, 0, 0))
+        console.print(x=x + 1, y=1, string=f"{'timer':<21}{'p50':>9}{'p95':>9}{'p99':>9}")
+        for i, (name, count, p50, p95, p99, worst) in enumerate(rows):
+            console.print(x=x + 1, y=i + 2, string=f"{name[:21]:<21}{p50:>9.2f}{p95:>9.2f}{p99:>9.2f}")
+
+profiler = Profiler()
+
+def profiled(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class DirtyLayers:
+    #screen layers changed since the last frame, main() only redraws and presents when there are any
+    LAYERS = ("map", "log", "hud", "hover", "modal")
+
+    def __init__(self):
+        self.layers = set(self.LAYERS)
+
+    def mark(self, *layers):
+        self.layers.update(layers or self.LAYERS)
+
+    def take(self):
+        layers, self.layers = self.layers, set()
+        return layers
+
+screen_dirty = DirtyLayers()
+
+def coalesce_events(events):
+    #a run of mouse motions collapses to the last one, and a run of repeats of the same held key to one step
+    #printable keys are each followed by a TextInput, which is looked past and dropped along with its merged key
+    merged = []
+    dropped_key = False
+    for event in events:
+        if isinstance(event, tcod.event.TextInput) and dropped_key:
+            dropped_key = False
+            continue
+        dropped_key = False
+        if merged:
+            last = merged[-1]
+            if isinstance(last, tcod.event.TextInput) and len(merged) > 1:
+                last = merged[-2]
+            if isinstance(event, tcod.event.MouseMotion) and isinstance(merged[-1], tcod.event.MouseMotion):
+                merged[-1] = event
+                continue
+            if isinstance(event, tcod.event.KeyDown) and isinstance(last, tcod.event.KeyDown) and event.repeat and last.repeat and event.sym == last.sym:
+                dropped_key = True
+                continue
+        merged.append(event)
+    return merged
+
+class BotPolicy:
+    def get_action(self, engine):
+        raise NotImplementedError()
+
+    def on_level_up(self, engine):
+        engine.level_up(0)
+
+    def on_new_floor(self, engine):
+        pass
+
+    def on_impossible(self, engine, action):
+        #action raised Impossible and changed nothing, so the same state will come back to get_action
+        pass
+
+class RandomWalkPolicy(BotPolicy):
+    def get_action(self, engine):
+        player = engine.player
+        if (player.x, player.y) == engine.game_map.downstairs_location:
+            return TakeStairsAction(player, 1)
+        roll = random.random()
+        if roll < 0.05:
+            return PickupAction(player)
+        if roll < 0.08 and player.inventory.items:
+            item = random.choice(player.inventory.items)
+            if item.equippable:
+                return EquipAction(player, item)
+            target = random.choice(list(engine.game_map.actors))
+            return ItemAction(player, item, (target.x, target.y))
+        if roll < 0.09 and player.inventory.items:
+            return DropItem(player, random.choice(player.inventory.items))
+        dx, dy = random.choice(list(MOVE_KEYS.values()))
+        return BumpAction(player, dx, dy)
+
+class DescendPolicy(BotPolicy):
+    def __init__(self):
+        self.path = []
+        #items that could not be used or equipped, left alone until the next floor
+        self.skipped = set()
+
+    def on_new_floor(self, engine):
+        self.path = []
+        self.skipped.clear()
+
+    def on_impossible(self, engine, action):
+        if isinstance(action, (ItemAction, EquipAction)):
+            self.skipped.add(action.item)
+        else:
+            self.path = []
+
+    def get_action(self, engine):
+        player = engine.player
+        game_map = engine.game_map
+        for dx, dy in set(MOVE_KEYS.values()):
+            target = game_map.get_actor_at_location(player.x + dx, player.y + dy)
+            if target:
+                item = self.find_item(player, (ArcaneDamageConsumable, FireballConsumable))
+                if item:
+                    return ItemAction(player, item, (target.x, target.y))
+                return BumpAction(player, dx, dy)
+        if player.fighter.hp <= player.fighter.max_hp // 2:
+            item = self.find_item(player, (HealingConsumable,))
+            if item:
+                return ItemAction(player, item)
+        for item in player.inventory.items:
+            if item.equippable and item not in self.skipped and not player.equipment.item_is_equipped(item):
+                current = player.equipment.slots.get(item.equippable.equipment_type)
+                if current is None or (item.equippable.power_bonus + item.equippable.defense_bonus > current.equippable.power_bonus + current.equippable.defense_bonus):
+                    return EquipAction(player, item)
+        if len(player.inventory.items) < player.inventory.capacity:
+            if any(isinstance(entity, Item) for entity in game_map.get_entities_at_location(player.x, player.y)):
+                return PickupAction(player)
+        if (player.x, player.y) == game_map.downstairs_location:
+            return TakeStairsAction(player, 1)
+        if not self.path or max(abs(self.path[0][0] - player.x), abs(self.path[0][1] - player.y)) != 1:
+            self.path = player.ai.get_path_to(*game_map.downstairs_location)
+        if self.path:
+            x, y = self.path.pop(0)
+            return BumpAction(player, x - player.x, y - player.y)
+        return WaitAction(player)
+
+    def find_item(self, player, consumable_types):
+        for item in player.inventory.items:
+            if isinstance(item.consumable, consumable_types) and item not in self.skipped:
+                return item
+        return None
+
+#a policy whose last this many actions in a row were all impossible is stuck, the game state can't change any more
+STALL_LIMIT = 100
+
+def run_headless(policy=None, max_turns=10000, seed=None, engine=None, record_path=None):
+    #plays until the player dies, max_turns actions have gone through or the policy stalls; impossible actions are not turns
+    if seed is not None:
+        random.seed(seed)
+    if engine is None:
+        engine = new_game(seed=seed)
+    if policy is None:
+        policy = DescendPolicy()
+    if record_path:
+        engine.recorder = ActionRecorder(record_path, engine)
+    handler = MainGameEventHandler(engine)
+    floor = engine.game_world.current_floor
+    turns = 0
+    failures = 0
+    while turns < max_turns and engine.player.isAlive and failures < STALL_LIMIT:
+        if engine.player.level.requires_level_up:
+            policy.on_level_up(engine)
+        action = policy.get_action(engine)
+        if handler.handle_action(action):
+            turns += 1
+            failures = 0
+        else:
+            failures += 1
+            policy.on_impossible(engine, action)
+        if engine.game_world.current_floor != floor:
+            floor = engine.game_world.current_floor
+            policy.on_new_floor(engine)
+    if engine.recorder:
+        engine.recorder.close()
+        engine.recorder = None
+    return engine, turns
+
+def run_status(engine, turns, max_turns):
+    #run_headless only stops early with the player alive when the policy stalled
+    if not engine.player.isAlive:
+        return "dead"
+    return "alive" if turns >= max_turns else "stalled"
+
+HEADLESS_POLICIES = {
+    "descend": DescendPolicy,
+    "random": RandomWalkPolicy,
+}
+
+class ActionRecorder:
+    #writes a new game's run seed and settings, then one short line per player action or level-up choice
+    def __init__(self, filename, engine):
+        game_world = engine.game_world
+        self.file = open(filename, "w", buffering=1)
+        self.file.write(json.dumps({
+            "version": 1,
+            "seed": game_world.seed,
+            "map_width": game_world.map_width,
+            "map_height": game_world.map_height,
+            "max_rooms": game_world.max_rooms,
+            "room_min_size": game_world.room_min_size,
+            "room_max_size": game_world.room_max_size,
+            "packs": LOADED_PACKS,
+        }) + "\n")
+
+    def record_action(self, engine, action):
+        self.file.write(" ".join(str(field) for field in encode_action(engine, action)) + "\n")
+
+    def record_level_up(self, choice):
+        self.file.write(f"L {choice}\n")
+
+    def close(self):
+        self.file.close()
+
+def encode_action(engine, action):
+    items = engine.player.inventory.items
+    if isinstance(action, BumpAction):
+        return ("B", action.dx, action.dy)
+    if isinstance(action, MovementAction):
+        return ("M", action.dx, action.dy)
+    if isinstance(action, MeleeAction):
+        return ("A", action.dx, action.dy)
+    if isinstance(action, DropItem):
+        return ("D", items.index(action.item))
+    if isinstance(action, ItemAction):
+        return ("I", items.index(action.item), *action.target_xy)
+    if isinstance(action, EquipAction):
+        return ("E", items.index(action.item))
+    if isinstance(action, PickupAction):
+        return ("P",)
+    if isinstance(action, TakeStairsAction):
+        return ("S",) if action.direction is None else ("S", action.direction)
+    if isinstance(action, WaitAction):
+        return ("W",)
+    raise ValueError(f"Cannot record {action!r}")
+
+def decode_action(engine, fields):
+    player = engine.player
+    code, args = fields[0], [int(field) for field in fields[1:]]
+    if code == "B":
+        return BumpAction(player, *args)
+    if code == "M":
+        return MovementAction(player, *args)
+    if code == "A":
+        return MeleeAction(player, *args)
+    if code == "D":
+        return DropItem(player, player.inventory.items[args[0]])
+    if code == "I":
+        return ItemAction(player, player.inventory.items[args[0]], (args[1], args[2]))
+    if code == "E":
+        return EquipAction(player, player.inventory.items[args[0]])
+    if code == "P":
+        return PickupAction(player)
+    if code == "S":
+        return TakeStairsAction(player, *args)
+    if code == "W":
+        return WaitAction(player)
+    raise ValueError(f"Unknown action code {code!r}")
+
+def replay(filename):
+    with open(filename) as f:
+        header = json.loads(f.readline())
+        records = [line.split() for line in f if line.strip()]
+    if header.get("packs", []) != LOADED_PACKS:
+        print(f"warning: {filename} was recorded with content packs {header.get('packs', [])}, loaded {LOADED_PACKS}", file=sys.stderr)
+    engine = new_game(
+        map_width=header["map_width"],
+        map_height=header["map_height"],
+        room_min_size=header["room_min_size"],
+        room_max_size=header["room_max_size"],
+        max_rooms=header["max_rooms"],
+        seed=header["seed"],
+    )
+    handler = MainGameEventHandler(engine)
+    timings = []
+    for fields in records:
+        if fields[0] == "L":
+            engine.level_up(int(fields[1]))
+            continue
+        floor = engine.game_world.current_floor
+        start = time.perf_counter()
+        handler.handle_action(decode_action(engine, fields))
+        timings.append({"turn": len(timings), "floor": floor, "action": " ".join(fields), "seconds": time.perf_counter() - start})
+    return engine, timings
+
+def replay_main(args):
+    start = time.perf_counter()
+    engine, timings = replay(args.replay)
+    elapsed = time.perf_counter() - start
+    print(f"replayed {len(timings)} turns in {elapsed:.2f}s ({len(timings) / max(elapsed, 1e-9):.0f} turns/s)")
+    if timings:
+        seconds = np.array([timing["seconds"] for timing in timings]) * 1000
+        p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+        print(f"per turn: mean {seconds.mean():.3f} ms, p50 {p50:.3f} ms, p95 {p95:.3f} ms, p99 {p99:.3f} ms, max {seconds.max():.3f} ms")
+        for timing in sorted(timings, key=lambda timing: timing["seconds"], reverse=True)[:5]:
+            print(f"  turn {timing['turn']} (floor {timing['floor']}, {timing['action']}): {timing['seconds'] * 1000:.3f} ms")
+    status = "alive" if engine.player.isAlive else "dead"
+    print(f"final state: floor {engine.game_world.current_floor}, level {engine.player.level.current_level}, HP {engine.player.fighter.hp}/{engine.player.fighter.max_hp}, {status}")
+    if args.timings:
+        with open(args.timings, "w") as f:
+            json.dump(timings, f)
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Dark Crypt")
+    parser.add_argument("--headless", action="store_true", help="run games without a window, driven by a bot policy")
+    parser.add_argument("--turns", type=int, default=10000)
+    parser.add_argument("--games", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--policy", choices=sorted(HEADLESS_POLICIES), default="descend")
+    parser.add_argument("--record", metavar="FILE", help="record the actions of new games to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="replay a recording headless as fast as possible")
+    parser.add_argument("--timings", metavar="FILE", help="with --replay, write per-turn timings to FILE as JSON")
+    parser.add_argument("--profile", action="store_true", help="turn the built-in timers on from the start, and print them after headless runs")
+    parser.add_argument("--packs", metavar="DIR", default=CONTENT_DIR, help="load content packs from DIR (default: packs/ next to main.py)")
+    parser.add_argument("--startup-check", action="store_true", help="exit after the first main menu frame, printing the time since launch and failing if it is over budget; with --headless the menu is drawn offscreen")
+    return parser.parse_args(argv)
+
+def headless_main(args):
+    total_turns = 0
+    start = time.perf_counter()
+    for game in range(args.games):
+        record_path = args.record if args.record and args.games == 1 else (f"{args.record}.{game}" if args.record else None)
+        engine, turns = run_headless(HEADLESS_POLICIES[args.policy](), max_turns=args.turns, seed=args.seed + game, record_path=record_path)
+        total_turns += turns
+        status = run_status(engine, turns, args.turns)
+        print(f"game {game}: seed {args.seed + game}, {turns} turns, floor {engine.game_world.current_floor}, level {engine.player.level.current_level}, {status}")
+    elapsed = time.perf_counter() - start
+    print(f"{total_turns} turns in {elapsed:.2f}s ({total_turns / max(elapsed, 1e-9):.0f} turns/s)")
+
+SLOT_NAMES = {}
+
+def slot_names(cls):
+    names = SLOT_NAMES.get(cls)
+    if names is None:
+        names = SLOT_NAMES[cls] = [name for klass in reversed(cls.__mro__) for name in vars(klass).get("__slots__", ())]
+    return names
+
+class Slotted:
+    #no per-instance __dict__, pickled as a plain attribute dict so saves from before __slots__ still load
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for name in slot_names(type(self)):
+            try:
+                state[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
 class RenderOrder(Enum):
     CORPSE = auto()
     ITEM = auto()
     ACTOR = auto()
 
-class Action:
+class Action(Slotted):
+    __slots__ = ("entity",)
+
     def __init__(self, entity):
         super().__init__()
         self.entity = entity
@@ -116,6 +690,8 @@ class Action:
         raise NotImplementedError()
 
 class ItemAction(Action):
+    __slots__ = ("item", "target_xy")
+
     def __init__(self, entity, item, target_xy=None):
         super().__init__(entity)
         self.item = item
@@ -132,12 +708,16 @@ class ItemAction(Action):
             self.item.consumable.activate(self)
     
 class DropItem(ItemAction):
+    __slots__ = ()
+
     def perform(self):
         if self.entity.equipment.item_is_equipped(self.item):
             self.entity.equipment.toggle_equip(self.item)
         self.entity.inventory.drop(self.item)
 
 class EquipAction(Action):
+    __slots__ = ("item",)
+
     def __init__(self, entity, item):
         super().__init__(entity)
         self.item = item
@@ -146,6 +726,8 @@ class EquipAction(Action):
         self.entity.equipment.toggle_equip(self.item)
     
 class ActionWithDirection(Action):
+    __slots__ = ("dx", "dy")
+
     def __init__(self, entity, dx: int, dy: int):
         super().__init__(entity)
 
@@ -168,6 +750,8 @@ class ActionWithDirection(Action):
         raise NotImplementedError()
     
 class MeleeAction(ActionWithDirection):
+    __slots__ = ()
+
     def perform(self):
         target = self.target_actor
         if not target:
@@ -185,6 +769,8 @@ class MeleeAction(ActionWithDirection):
             self.engine.message_log.add_message(f"{attack_desc} but does no damage.", attack_color)
 
 class BumpAction(ActionWithDirection):
+    __slots__ = ()
+
     def perform(self):
         if self.target_actor:
             return MeleeAction(self.entity, self.dx, self.dy).perform()
@@ -192,6 +778,8 @@ class BumpAction(ActionWithDirection):
             return MovementAction(self.entity, self.dx, self.dy).perform()
 
 class MovementAction(ActionWithDirection):
+    __slots__ = ()
+
     def perform(self):
         dest_x, dest_y = self.dest_xy
         if not self.engine.game_map.in_bounds(dest_x, dest_y):
@@ -203,10 +791,13 @@ class MovementAction(ActionWithDirection):
         self.entity.move(self.dx, self.dy)
 
 class WaitAction(Action):
+    __slots__ = ()
+
     def perform(self):
         pass
 
 class PickupAction(Action):
+    __slots__ = ()
 
     def __init__(self, entity):
         super().__init__(entity)
@@ -216,12 +807,12 @@ class PickupAction(Action):
         actor_location_y = self.entity.y
         inventory = self.entity.inventory
 
-        for item in self.engine.game_map.items:
-            if actor_location_x == item.x and actor_location_y == item.y:
+        for item in self.engine.game_map.get_entities_at_location(actor_location_x, actor_location_y):
+            if isinstance(item, Item):
                 if len(inventory.items) >= inventory.capacity:
                     raise Impossible("Your inventory is full.")
 
-                self.engine.game_map.entities.remove(item)
+                self.engine.game_map.remove_entity(item)
                 item.parent = self.entity.inventory
                 inventory.items.append(item)
 
@@ -231,64 +822,89 @@ class PickupAction(Action):
         raise Impossible("There is nothing here to pick up.")
     
 class TakeStairsAction(Action):
+    __slots__ = ("direction",)
+
+    def __init__(self, entity, direction=None):
+        super().__init__(entity)
+        #1 to go down, -1 to go up, None for whichever staircase is here (recordings from before the two were told apart)
+        self.direction = direction
+
     def perform(self):
-        if (self.entity.x, self.entity.y) == self.engine.game_map.downstairs_location:
+        location = self.entity.x, self.entity.y
+        game_map = self.engine.game_map
+        if location not in (game_map.downstairs_location, game_map.upstairs_location):
+            raise Impossible("There are no stairs here.")
+        if location == game_map.downstairs_location and self.direction != -1:
             self.engine.game_world.generate_floor()
             self.engine.message_log.add_message("You descend the staircase.", descend)
+        elif location == game_map.upstairs_location and self.direction != 1:
+            self.engine.game_world.change_floor(self.engine.game_world.current_floor - 1)
+            self.engine.message_log.add_message("You ascend the staircase.", descend)
+        elif self.direction == 1:
+            raise Impossible("These stairs only lead up.")
         else:
-            raise Impossible("There are no stairs here.")
+            raise Impossible("These stairs only lead down.")
 
 MOVE_KEYS = {
     # Arrow keys.
-    tcod.event.K_UP: (0, -1),
-    tcod.event.K_DOWN: (0, 1),
-    tcod.event.K_LEFT: (-1, 0),
-    tcod.event.K_RIGHT: (1, 0),
-    tcod.event.K_HOME: (-1, -1),
-    tcod.event.K_END: (-1, 1),
-    tcod.event.K_PAGEUP: (1, -1),
-    tcod.event.K_PAGEDOWN: (1, 1),
+    tcod.event.KeySym.UP: (0, -1),
+    tcod.event.KeySym.DOWN: (0, 1),
+    tcod.event.KeySym.LEFT: (-1, 0),
+    tcod.event.KeySym.RIGHT: (1, 0),
+    tcod.event.KeySym.HOME: (-1, -1),
+    tcod.event.KeySym.END: (-1, 1),
+    tcod.event.KeySym.PAGEUP: (1, -1),
+    tcod.event.KeySym.PAGEDOWN: (1, 1),
     # Numpad keys.
-    tcod.event.K_KP_1: (-1, 1),
-    tcod.event.K_KP_2: (0, 1),
-    tcod.event.K_KP_3: (1, 1),
-    tcod.event.K_KP_4: (-1, 0),
-    tcod.event.K_KP_6: (1, 0),
-    tcod.event.K_KP_7: (-1, -1),
-    tcod.event.K_KP_8: (0, -1),
-    tcod.event.K_KP_9: (1, -1),
+    tcod.event.KeySym.KP_1: (-1, 1),
+    tcod.event.KeySym.KP_2: (0, 1),
+    tcod.event.KeySym.KP_3: (1, 1),
+    tcod.event.KeySym.KP_4: (-1, 0),
+    tcod.event.KeySym.KP_6: (1, 0),
+    tcod.event.KeySym.KP_7: (-1, -1),
+    tcod.event.KeySym.KP_8: (0, -1),
+    tcod.event.KeySym.KP_9: (1, -1),
     # Vi keys.
-    tcod.event.K_h: (-1, 0),
-    tcod.event.K_j: (0, 1),
-    tcod.event.K_k: (0, -1),
-    tcod.event.K_l: (1, 0),
-    tcod.event.K_y: (-1, -1),
-    tcod.event.K_u: (1, -1),
-    tcod.event.K_b: (-1, 1),
-    tcod.event.K_n: (1, 1),
+    tcod.event.KeySym.H: (-1, 0),
+    tcod.event.KeySym.J: (0, 1),
+    tcod.event.KeySym.K: (0, -1),
+    tcod.event.KeySym.L: (1, 0),
+    tcod.event.KeySym.Y: (-1, -1),
+    tcod.event.KeySym.U: (1, -1),
+    tcod.event.KeySym.B: (-1, 1),
+    tcod.event.KeySym.N: (1, 1),
 }
 
 WAIT_KEYS = {
-    tcod.event.K_PERIOD,
-    tcod.event.K_KP_5,
-    tcod.event.K_CLEAR,
+    tcod.event.KeySym.PERIOD,
+    tcod.event.KeySym.KP_5,
+    tcod.event.KeySym.CLEAR,
 }
 
 CONFIRM_KEYS = {
-    tcod.event.K_RETURN,
-    tcod.event.K_KP_ENTER,
+    tcod.event.KeySym.RETURN,
+    tcod.event.KeySym.KP_ENTER,
 }
 
 CURSOR_Y_KEYS = {
-    tcod.event.K_UP: -1,
-    tcod.event.K_DOWN: 1,
-    tcod.event.K_PAGEUP: -10,
-    tcod.event.K_PAGEDOWN: 10,
+    tcod.event.KeySym.UP: -1,
+    tcod.event.KeySym.DOWN: 1,
+    tcod.event.KeySym.PAGEUP: -10,
+    tcod.event.KeySym.PAGEDOWN: 10,
 }
 
-ActionOrHandler = Union[Action, "BaseEventHandler"]
+#the events handlers react to and the ev_* method each goes to, anything else is ignored
+EVENT_METHODS = {
+    tcod.event.Quit: "ev_quit",
+    tcod.event.KeyDown: "ev_keydown",
+    tcod.event.MouseMotion: "ev_mousemotion",
+    tcod.event.MouseButtonDown: "ev_mousebuttondown",
+}
 
-class BaseEventHandler(tcod.event.EventDispatch[ActionOrHandler]):
+class BaseEventHandler:
+    def dispatch(self, event):
+        method = getattr(self, EVENT_METHODS.get(type(event), ""), None)
+        return method(event) if method else None
     def handle_events(self, event):
         state = self.dispatch(event)
         if isinstance(state, BaseEventHandler):
@@ -301,16 +917,27 @@ class BaseEventHandler(tcod.event.EventDispatch[ActionOrHandler]):
         raise SystemExit()
 
 class MainMenu(BaseEventHandler):
+    def __init__(self, record_path=None):
+        self.record_path = record_path
+        self.save_summary = describe_save("savegame.sav")
+
     def on_render(self, console):
-        console.print(console.width // 2, console.height // 2 - 4, "DARK CRYPT", fg=menu_title, alignment=tcod.CENTER)
-        console.print(console.width // 2, console.height // 2 - 2, "By Raymond Wu", fg=menu_title, alignment=tcod.CENTER)
+        console.print(console.width // 2, console.height // 2 - 4, "DARK CRYPT", fg=menu_title, alignment=libtcodpy.CENTER)
+        console.print(console.width // 2, console.height // 2 - 2, "By Raymond Wu", fg=menu_title, alignment=libtcodpy.CENTER)
         menu_width = 24
         for i, txt in enumerate(["[N] Start new game", "[C] Continue last game", "[Q] Quit"]):
-            console.print(console.width // 2, console.height // 2 - 2 + i, txt.ljust(menu_width), fg=menu_text, bg=black, alignment=tcod.CENTER, bg_blend=tcod.BKGND_ALPHA(64))
+            console.print(console.width // 2, console.height // 2 - 2 + i, txt.ljust(menu_width), fg=menu_text, bg=black, alignment=libtcodpy.CENTER, bg_blend=libtcodpy.BKGND_ALPHA(64))
+        if self.save_summary:
+            console.print(console.width // 2, console.height // 2 + 2, f"Last save: {self.save_summary}", fg=menu_text, alignment=libtcodpy.CENTER)
     def ev_keydown(self, event):
-        if event.sym in (tcod.event.K_q, tcod.event.K_ESCAPE):
+        if event.sym in (tcod.event.KeySym.Q, tcod.event.KeySym.ESCAPE):
             raise SystemExit()
-        elif event.sym == tcod.event.K_c:
+        if event.sym in (tcod.event.KeySym.C, tcod.event.KeySym.N):
+            try:
+                load_pending_packs()
+            except ContentError as exc:
+                return PopupMessage(self, f"Could not load content packs:\n{exc}")
+        if event.sym == tcod.event.KeySym.C:
             try:
                 return MainGameEventHandler(load_game("savegame.sav"))
             except FileNotFoundError:
@@ -318,8 +945,11 @@ class MainMenu(BaseEventHandler):
             except Exception as exc:
                 traceback.print_exc()
                 return PopupMessage(self, f"Failed to load save:\n{exc}")
-        elif event.sym == tcod.event.K_n:
-            return MainGameEventHandler(new_game())
+        elif event.sym == tcod.event.KeySym.N:
+            engine = new_game(pregenerate=True)
+            if self.record_path:
+                engine.recorder = ActionRecorder(self.record_path, engine)
+            return MainGameEventHandler(engine)
         return None
     
 class PopupMessage(BaseEventHandler):
@@ -330,7 +960,7 @@ class PopupMessage(BaseEventHandler):
         self.parent.on_render(console)
         console.tiles_rgb["fg"] //= 8
         console.tiles_rgb["bg"] //= 8
-        console.print(console.width // 2, console.height // 2, self.text, fg=white, bg=black, alignment=tcod.CENTER)
+        console.print(console.width // 2, console.height // 2, self.text, fg=white, bg=black, alignment=libtcodpy.CENTER)
     def ev_keydown(self, event):
         return self.parent
 
@@ -353,18 +983,26 @@ class EventHandler(BaseEventHandler):
     def handle_action(self, action):
         if action is None:
             return False
-        try:
-            action.perform()
-        except Impossible as exc:
-            self.engine.message_log.add_message(exc.args[0], impossible)
-            return False
-        self.engine.handle_enemy_turns()
-        self.engine.update_fov()
+        if self.engine.recorder:
+            self.engine.recorder.record_action(self.engine, action)
+        with profiler.timer("turn"):
+            try:
+                with profiler.timer("action", type(action).__name__):
+                    action.perform()
+            except Impossible as exc:
+                self.engine.message_log.add_message(exc.args[0], impossible)
+                return False
+            self.engine.handle_enemy_turns()
+            self.engine.player.fighter.tick_buffs()
+            self.engine.update_fov()
+        screen_dirty.mark("map", "hud", "log")
         return True
 
     def ev_mousemotion(self, event):
-        if self.engine.game_map.in_bounds(event.tile.x, event.tile.y):
-            self.engine.mouse_location = event.tile.x, event.tile.y
+        location = self.engine.screen_to_map(event.tile.x, event.tile.y)
+        if location and location != self.engine.mouse_location:
+            self.engine.mouse_location = location
+            screen_dirty.mark("hover")
     
     def on_render(self, console):
         self.engine.render(console)
@@ -373,12 +1011,12 @@ class AskUserEventHandler(EventHandler):
 
     def ev_keydown(self, event):
         if event.sym in { 
-            tcod.event.K_LSHIFT,
-            tcod.event.K_RSHIFT,
-            tcod.event.K_LCTRL,
-            tcod.event.K_RCTRL,
-            tcod.event.K_LALT,
-            tcod.event.K_RALT,
+            tcod.event.KeySym.LSHIFT,
+            tcod.event.KeySym.RSHIFT,
+            tcod.event.KeySym.LCTRL,
+            tcod.event.KeySym.RCTRL,
+            tcod.event.KeySym.LALT,
+            tcod.event.KeySym.RALT,
         }:
             return None
         return self.on_exit()
@@ -393,7 +1031,7 @@ class CharacterScreenEventHandler(AskUserEventHandler):
     TITLE = "Character Information"
     def on_render(self, console):
         super().on_render(console)
-        if self.engine.player.x <= 30:
+        if self.engine.map_to_screen(self.engine.player.x, self.engine.player.y)[0] <= 30:
             x = 40
         else:
             x = 0
@@ -427,11 +1065,11 @@ class HistoryViewer(EventHandler):
 
     def on_render(self, console):
         super().on_render(console)
-        log_console = tcod.Console(console.width - 6, console.height - 6)
+        log_console = Console(console.width - 6, console.height - 6)
         log_console.draw_frame(0, 0, log_console.width, log_console.height)
-        log_console.print_box(0, 0, log_console.width, 1, "┤Message history├", alignment=tcod.CENTER)
+        log_console.print_box(0, 0, log_console.width, 1, "┤Message history├", alignment=libtcodpy.CENTER)
 
-        self.engine.message_log.render_messages(log_console, 1, 1, log_console.width - 2, log_console.height - 2, self.engine.message_log.messages[:self.cursor + 1])
+        self.engine.message_log.render(log_console, 1, 1, log_console.width - 2, log_console.height - 2, end=self.cursor)
         log_console.blit(console, 3, 3)
 
     def ev_keydown(self, event):
@@ -456,27 +1094,27 @@ class MainGameEventHandler(EventHandler):
         modifier = event.mod
         player = self.engine.player
 
-        if key == tcod.event.K_PERIOD and modifier & (tcod.event.KMOD_LSHIFT | tcod.event.KMOD_RSHIFT):
-            return TakeStairsAction(player)
+        if key in (tcod.event.KeySym.PERIOD, tcod.event.KeySym.COMMA) and modifier & (tcod.event.Modifier.LSHIFT | tcod.event.Modifier.RSHIFT):
+            return TakeStairsAction(player, 1 if key == tcod.event.KeySym.PERIOD else -1)
 
         if key in MOVE_KEYS:
             dx, dy = MOVE_KEYS[key]
             action = BumpAction(player, dx, dy)
         elif key in WAIT_KEYS:
             action = WaitAction(player)
-        elif key == tcod.event.K_ESCAPE:
+        elif key == tcod.event.KeySym.ESCAPE:
             raise SystemExit()
-        elif key == tcod.event.K_v:
+        elif key == tcod.event.KeySym.V:
             return HistoryViewer(self.engine)
-        elif key == tcod.event.K_g:
+        elif key == tcod.event.KeySym.G:
             action = PickupAction(player)
-        elif key == tcod.event.K_i:
+        elif key == tcod.event.KeySym.I:
             return InventoryActivateHandler(self.engine)
-        elif key == tcod.event.K_d:
+        elif key == tcod.event.KeySym.D:
             return InventoryDropHandler(self.engine)
-        elif key == tcod.event.K_SLASH:
+        elif key == tcod.event.KeySym.SLASH:
             return LookHandler(self.engine)
-        elif key == tcod.event.K_c:
+        elif key == tcod.event.KeySym.C:
             return CharacterScreenEventHandler(self.engine)
         return action
 
@@ -490,18 +1128,18 @@ class GameOverEventHandler(EventHandler):
         self.on_quit()
 
     def ev_keydown(self, event):
-        if event.sym == tcod.event.K_ESCAPE:
+        if event.sym == tcod.event.KeySym.ESCAPE:
             self.on_quit()
         
 class InventoryEventHandler(AskUserEventHandler):
     TITLE = "<missing title>"
-    def on_render(self, console: tcod.Console) -> None:
+    def on_render(self, console: Console) -> None:
         super().on_render(console)
         number_of_items_in_inventory = len(self.engine.player.inventory.items)
         height = number_of_items_in_inventory + 2
         if height <= 3:
             height = 3
-        if self.engine.player.x <= 30:
+        if self.engine.map_to_screen(self.engine.player.x, self.engine.player.y)[0] <= 30:
             x = 40
         else:
             x = 0
@@ -531,7 +1169,7 @@ class InventoryEventHandler(AskUserEventHandler):
     def ev_keydown(self, event):
         player = self.engine.player
         key = event.sym
-        index = key - tcod.event.K_a
+        index = key - tcod.event.KeySym.A
         if 0 <= index <= 26:
             try:
                 selected_item = player.inventory.items[index]
@@ -568,7 +1206,7 @@ class SelectIndexHandler(AskUserEventHandler):
 
     def on_render(self, console):
         super().on_render(console)
-        x, y = self.engine.mouse_location
+        x, y = self.engine.map_to_screen(*self.engine.mouse_location)
         console.tiles_rgb["bg"][x, y] = white
         console.tiles_rgb["fg"][x, y] = black
 
@@ -576,19 +1214,20 @@ class SelectIndexHandler(AskUserEventHandler):
         key = event.sym
         if key in MOVE_KEYS:
             modifier = 1
-            if event.mod & (tcod.event.KMOD_LSHIFT | tcod.event.KMOD_RSHIFT):
+            if event.mod & (tcod.event.Modifier.LSHIFT | tcod.event.Modifier.RSHIFT):
                 modifier *= 5
-            if event.mod & (tcod.event.KMOD_LCTRL | tcod.event.KMOD_RCTRL):
+            if event.mod & (tcod.event.Modifier.LCTRL | tcod.event.Modifier.RCTRL):
                 modifier *= 10
-            if event.mod & (tcod.event.KMOD_LALT | tcod.event.KMOD_RALT):
+            if event.mod & (tcod.event.Modifier.LALT | tcod.event.Modifier.RALT):
                 modifier *= 20
             
             x, y = self.engine.mouse_location
             dx, dy = MOVE_KEYS[key]
             x += dx * modifier
             y += dy * modifier
-            x = max(0, min(x, self.engine.game_map.width - 1))
-            y = max(0, min(y, self.engine.game_map.height - 1))
+            x1, y1, x2, y2 = self.engine.view_bounds
+            x = max(x1, min(x, x2 - 1))
+            y = max(y1, min(y, y2 - 1))
             self.engine.mouse_location = x, y
             return None
         elif key in CONFIRM_KEYS:
@@ -596,9 +1235,10 @@ class SelectIndexHandler(AskUserEventHandler):
         return super().ev_keydown(event)
     
     def ev_mousebuttondown(self, event):
-        if self.engine.game_map.in_bounds(*event.tile):
+        location = self.engine.screen_to_map(*event.tile)
+        if location:
             if event.button == 1:
-                return self.on_index_selected(*event.tile)
+                return self.on_index_selected(*location)
         return super().ev_mousebuttondown(event)
     
     def on_index_selected(self, x, y):
@@ -624,7 +1264,7 @@ class AreaRangedAttackHandler(SelectIndexHandler):
 
     def on_render(self, console):
         super().on_render(console)
-        x, y = self.engine.mouse_location
+        x, y = self.engine.map_to_screen(*self.engine.mouse_location)
         console.draw_frame(
             x=x - self.radius - 1,
             y=y - self.radius - 1,
@@ -640,7 +1280,7 @@ class LevelUpEventHandler(AskUserEventHandler):
     TITLE = "Level Up"
     def on_render(self, console):
         super().on_render(console)
-        if self.engine.player.x <= 30:
+        if self.engine.map_to_screen(self.engine.player.x, self.engine.player.y)[0] <= 30:
             x = 40
         else:
             x = 0
@@ -664,16 +1304,10 @@ class LevelUpEventHandler(AskUserEventHandler):
         )
 
     def ev_keydown(self, event):
-        player = self.engine.player
         key = event.sym
-        index = key - tcod.event.K_a
+        index = key - tcod.event.KeySym.A
         if 0 <= index <= 2:
-            if index == 0:
-                player.level.increase_max_hp()
-            elif index == 1:
-                player.level.increase_power()
-            else:
-                player.level.increase_defense()
+            self.engine.level_up(index)
         else:
             self.engine.message_log.add_message("Invalid entry", invalid)
             return None
@@ -683,7 +1317,9 @@ class LevelUpEventHandler(AskUserEventHandler):
 
 T = TypeVar("T", bound="Entity")
 
-class Entity:
+class Entity(Slotted):
+    __slots__ = ("parent", "x", "y", "char", "color", "name", "blocks_movement", "render_order")
+
     def __init__(self, parent = None, x = 0, y = 0, char = "?", color = (255, 255, 255), name = "<Unnamed>", blocks_movement = False, render_order = RenderOrder.CORPSE):
         self.x = x
         self.y = y
@@ -694,22 +1330,26 @@ class Entity:
         self.render_order = render_order
         if parent:
             self.parent = parent
-            parent.entities.add(self)
+            parent.add_entity(self)
 
     @property
     def gamemap(self):
         return self.parent.gamemap
 
     def spawn(self, gamemap, x, y):
-        clone = copy.deepcopy(self)
+        clone = prefab_for(self).build()
         clone.x, clone.y = x, y
         clone.parent = gamemap
-        gamemap.entities.add(clone)
+        gamemap.add_entity(clone)
         return clone
 
     def move(self, dx, dy):
-        self.x += dx
-        self.y += dy
+        parent = getattr(self, "parent", None)
+        if isinstance(parent, GameMap):
+            parent.move_entity(self, self.x + dx, self.y + dy)
+        else:
+            self.x += dx
+            self.y += dy
 
     def place(self, x, y, gamemap):
         self.x = x
@@ -717,16 +1357,70 @@ class Entity:
         if gamemap:
             if hasattr(self, "parent"):
                 if self.parent is self.gamemap:
-                    self.gamemap.entities.remove(self)
+                    self.gamemap.remove_entity(self)
             self.parent = gamemap
-            gamemap.entities.add(self)
+            gamemap.add_entity(self)
     
     def distance(self, x, y):
         return math.sqrt((x - self.x) ** 2 + (y - self.y) ** 2)
 
+class Prefab:
+    #a template entity compiled into a class plus an attribute snapshot for it and each component
+    def __init__(self, template):
+        self.cls = type(template)
+        self.state = {key: value for key, value in template.__getstate__().items() if key != "parent"}
+        self.components = []
+        for name, component in self.state.items():
+            if isinstance(component, (BaseComponent, BaseAI)):
+                component_state = {key: value for key, value in component.__getstate__().items() if key not in ("parent", "entity")}
+                containers = [key for key, value in component_state.items() if isinstance(value, (list, dict))]
+                self.components.append((name, type(component), component_state, containers))
+        self.items = []
+        self.equipped = {}
+        if isinstance(template, Actor):
+            self.items = [Prefab(item) for item in template.inventory.items]
+            for slot, item in template.equipment.slots.items():
+                self.equipped[slot] = template.inventory.items.index(item)
+
+    def build(self):
+        entity = self.cls.__new__(self.cls)
+        for key, value in self.state.items():
+            setattr(entity, key, value)
+        for name, cls, state, containers in self.components:
+            component = cls.__new__(cls)
+            for key, value in state.items():
+                setattr(component, key, value)
+            for key in containers:
+                setattr(component, key, state[key].copy())
+            if isinstance(component, BaseAI):
+                component.entity = entity
+            else:
+                component.parent = entity
+            setattr(entity, name, component)
+        if self.items:
+            items = [prefab.build() for prefab in self.items]
+            for item in items:
+                item.parent = entity.inventory
+            entity.inventory.items = items
+            for slot, index in self.equipped.items():
+                entity.equipment.slots[slot] = items[index]
+            entity.equipment.invalidate()
+        return entity
+
+PREFABS = {}
+
+def prefab_for(template):
+    prefab = PREFABS.get(template)
+    if prefab is None:
+        prefab = PREFABS[template] = Prefab(template)
+    return prefab
+
 class Actor(Entity):
-    def __init__(self, *, x=0, y=0, char="?", color=(255, 255, 255), name="<Unnamed>", ai_cls, equipment, fighter, inventory, level):
+    __slots__ = ("speed", "ai", "equipment", "fighter", "inventory", "level")
+
+    def __init__(self, *, x=0, y=0, char="?", color=(255, 255, 255), name="<Unnamed>", ai_cls, equipment, fighter, inventory, level, speed=100):
         super().__init__(x=x, y=y, char=char, color=color, name=name, blocks_movement=True, render_order=RenderOrder.ACTOR)
+        self.speed = speed
         self.ai = ai_cls(self)
         self.equipment = equipment
         self.equipment.parent = self
@@ -737,11 +1431,22 @@ class Actor(Entity):
         self.level = level
         self.level.parent = self
 
+    def __setstate__(self, state):
+        state.setdefault("speed", 100)
+        super().__setstate__(state)
+
     @property
     def isAlive(self):
         return bool(self.ai)
 
+    def sync_actor_store(self):
+        parent = getattr(self, "parent", None)
+        if isinstance(parent, GameMap):
+            parent.actor_store.update(self)
+
 class Item(Entity):
+    __slots__ = ("consumable", "equippable")
+
     def __init__(self, *, x=0, y=0, char="?", color=(255, 255, 255), name="<Unnamed>", consumable=None, equippable=None):
         super().__init__(x=x, y=y, char=char, color=color, name=name, blocks_movement=False, render_order=RenderOrder.ITEM)
         self.consumable = consumable
@@ -752,35 +1457,70 @@ class Item(Entity):
             self.equippable.parent = self
 
 class Engine:
+    viewport_width = 80
+    viewport_height = 43
+    recorder = None
+
     def __init__(self, player):
         self.message_log = MessageLog()
-        self.mouse_loc = (0, 0)
+        self.mouse_location = (0, 0)
         self.player = player
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("recorder", None)
+        return state
+
+    def __setstate__(self, state):
+        #older saves kept the hover position under mouse_loc, which nothing updated
+        state.pop("mouse_loc", None)
+        state.setdefault("mouse_location", (0, 0))
+        self.__dict__.update(state)
+
+    def level_up(self, choice):
+        if self.recorder:
+            self.recorder.record_level_up(choice)
+        level = self.player.level
+        (level.increase_max_hp, level.increase_power, level.increase_defense)[choice]()
+
+    @profiled("enemy_turns")
     def handle_enemy_turns(self):
-        for entity in set(self.game_map.actors) - {self.player}:
-            if entity.ai:
-                try:
-                    entity.ai.perform()
-                except Impossible:
-                    pass
+        self.game_map.set_flow_target(self.player.x, self.player.y)
+        self.game_map.scheduler.run(self.game_map, self.player)
     
+    @profiled("update_fov")
     def update_fov(self):
-        self.game_map.visible[:] = compute_fov(self.game_map.tiles["transparent"], (self.player.x, self.player.y), radius=8)
-        self.game_map.explored |= self.game_map.visible
+        self.game_map.update_fov(self.player.x, self.player.y, FOV_RADIUS)
     
+    @property
+    def view_bounds(self):
+        #map-space rectangle shown on screen, centered on the player and clamped to the map edges
+        x1 = min(max(self.player.x - self.viewport_width // 2, 0), max(0, self.game_map.width - self.viewport_width))
+        y1 = min(max(self.player.y - self.viewport_height // 2, 0), max(0, self.game_map.height - self.viewport_height))
+        return x1, y1, min(self.game_map.width, x1 + self.viewport_width), min(self.game_map.height, y1 + self.viewport_height)
+
+    def map_to_screen(self, x, y):
+        x1, y1, _, _ = self.view_bounds
+        return x - x1, y - y1
+
+    def screen_to_map(self, x, y):
+        x1, y1, x2, y2 = self.view_bounds
+        if 0 <= x < x2 - x1 and 0 <= y < y2 - y1:
+            return x + x1, y + y1
+        return None
+
     def render(self, console):
-        self.game_map.render(console)
+        self.game_map.render(console, self.view_bounds)
         self.message_log.render(console=console, x=21, y=45, width=40, height=5)
         render_bar(console=console, curr_value=self.player.fighter.hp, max_value=self.player.fighter.max_hp, total_width=20)
         render_dungeon_level(console=console, dungeon_level=self.game_world.current_floor, location=(0, 47))
         render_names_at_mouse_loc(console=console, x=21, y=44, engine=self)
 
-    def save_as(self, filename):
-        save_data = lzma.compress(pickle.dumps(self))
-        with open(filename, "wb") as f:
-            f.write(save_data)
+    def save_as(self, filename, codec="zlib", background=False, on_saved=None):
+        return write_save(self, filename, codec=codec, background=background, on_saved=on_saved)
     
+FOV_RADIUS = 8
+
 graphic_dt = np.dtype([("ch", np.int32), ("fg", "3B"), ("bg", "3B")])
 tile_dt = np.dtype([("walkable", bool), ("transparent", bool), ("dark", graphic_dt), ("light", graphic_dt)])
 def new_tile(*, walkable, transparent, dark, light):
@@ -789,37 +1529,468 @@ SHROUD = np.array((ord(" "), (255, 255, 255), (0, 0, 0)), dtype=graphic_dt)
 floor = new_tile(walkable=True, transparent=True, dark=(ord("."), (100, 100, 100), (0, 0, 0)), light=(ord("."), (200, 200, 200), (0, 0, 0)))
 wall = new_tile(walkable=False, transparent=False, dark=(ord("#"), (100, 100, 100), (0, 0, 0)), light=(ord("#"), (200, 200, 200), (0, 0, 0)))
 down_stairs = new_tile(walkable=True, transparent=True, dark=(ord(">"), (100, 100, 100), (0, 0, 0)), light=(ord(">"), (200, 200, 200), (0, 0, 0)))
+up_stairs = new_tile(walkable=True, transparent=True, dark=(ord("<"), (100, 100, 100), (0, 0, 0)), light=(ord("<"), (200, 200, 200), (0, 0, 0)))
+TILE_PALETTE = [wall, floor, down_stairs, up_stairs]
+
+def pack_tiles(tiles):
+    #store a tile map as a palette plus one uint8 index per cell
+    cells = tiles.ravel(order="F").view(np.dtype((np.void, tile_dt.itemsize)))
+    indices = np.full(cells.shape, 255, dtype=np.uint8)
+    palette = list(TILE_PALETTE)
+    for i, tile in enumerate(palette):
+        indices[cells == np.frombuffer(tile.tobytes(), dtype=cells.dtype)[0]] = i
+    unknown = indices == 255
+    if unknown.any():
+        extra, inverse = np.unique(cells[unknown], return_inverse=True)
+        indices[unknown] = len(palette) + inverse.ravel()
+        palette.extend(np.frombuffer(tile.tobytes(), dtype=tile_dt)[0] for tile in extra)
+    return np.array(palette, dtype=tile_dt), indices
+
+def unpack_tiles(palette, indices, width, height):
+    cells = palette.view(np.dtype((np.void, tile_dt.itemsize)))[indices].view(tile_dt)
+    return cells.reshape((width, height), order="F")
+
+def pack_mask(mask):
+    return np.packbits(mask.ravel(order="F"))
+
+def unpack_mask(packed, width, height):
+    return np.unpackbits(packed, count=width * height).astype(bool).reshape((width, height), order="F")
+
+class ActorStore:
+    #struct-of-arrays copy of every actor's position and combat stats, for vectorized queries
+    def __init__(self, capacity=64):
+        self.x = np.zeros(capacity, dtype=np.int32)
+        self.y = np.zeros(capacity, dtype=np.int32)
+        self.hp = np.zeros(capacity, dtype=np.int32)
+        self.power = np.zeros(capacity, dtype=np.int32)
+        self.defense = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.actors = []
+        self.slots = {}
+        self.free_slots = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, actor):
+        if actor not in self.slots:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.actors[slot] = actor
+            else:
+                slot = len(self.actors)
+                if slot == len(self.alive):
+                    self._grow()
+                self.actors.append(actor)
+            self.slots[actor] = slot
+        self.update(actor)
+
+    def remove(self, actor):
+        slot = self.slots.pop(actor, None)
+        if slot is None:
+            return
+        self.alive[slot] = False
+        self.actors[slot] = None
+        self.free_slots.append(slot)
+
+    def update(self, actor):
+        slot = self.slots.get(actor)
+        if slot is None:
+            return
+        self.x[slot] = actor.x
+        self.y[slot] = actor.y
+        self.hp[slot] = actor.fighter.hp
+        self.power[slot] = actor.fighter.power
+        self.defense[slot] = actor.fighter.defense
+        self.alive[slot] = actor.isAlive
+
+    def move(self, actor, x, y):
+        slot = self.slots.get(actor)
+        if slot is not None:
+            self.x[slot] = x
+            self.y[slot] = y
+
+    def _grow(self):
+        for name in ("x", "y", "hp", "power", "defense", "alive"):
+            old = getattr(self, name)
+            new = np.zeros(len(old) * 2, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def alive_actors(self):
+        n = len(self.actors)
+        return [self.actors[i] for i in np.flatnonzero(self.alive[:n])]
+
+    def squared_distances(self, x, y):
+        n = len(self.actors)
+        dx = self.x[:n] - x
+        dy = self.y[:n] - y
+        return dx * dx + dy * dy
+
+    def in_radius(self, x, y, radius):
+        n = len(self.actors)
+        hits = np.flatnonzero(self.alive[:n] & (self.squared_distances(x, y) <= radius * radius))
+        return [self.actors[i] for i in hits]
+
+    def nearest(self, x, y, max_distance, visible=None, exclude=None):
+        #closest living actor strictly within max_distance, optionally only on visible tiles
+        n = len(self.actors)
+        if n == 0:
+            return None
+        candidates = self.alive[:n].copy()
+        if visible is not None:
+            candidates &= visible[self.x[:n], self.y[:n]]
+        if exclude in self.slots:
+            candidates[self.slots[exclude]] = False
+        #only look at the candidates, a sentinel distance for the rest would have to fit the coordinates' dtype
+        indices = np.flatnonzero(candidates)
+        if len(indices) == 0:
+            return None
+        distances = self.squared_distances(x, y)[indices]
+        best = int(np.argmin(distances))
+        if distances[best] < max_distance * max_distance:
+            return self.actors[indices[best]]
+        return None
+
+ENERGY_PER_ACTION = 100
+#enemies see the player through the FOV computed before the player's last step, so wake a little beyond it
+WAKE_RADIUS = FOV_RADIUS + 2
+#how far the shared flow field reaches around the player, room for monsters in view to path around things
+FLOW_RADIUS = 2 * FOV_RADIUS
+
+class TurnScheduler:
+    #only monsters near the player or still busy take turns, the rest of the floor stays dormant until approached
+    def __init__(self):
+        self.energy = {}
+
+    def __len__(self):
+        return len(self.energy)
+
+    def discard(self, actor):
+        self.energy.pop(actor, None)
+
+    def run(self, game_map, player):
+        store = game_map.actor_store
+        nearby = store.in_radius(player.x, player.y, WAKE_RADIUS)
+        for actor in nearby:
+            if actor is not player and actor not in self.energy:
+                self.energy[actor] = 0
+        nearby = set(nearby)
+        #same order as the actor store so turns resolve the same way whether or not anyone slept
+        for actor in sorted(self.energy, key=store.slots.get):
+            if not actor.isAlive or actor.gamemap is not game_map:
+                del self.energy[actor]
+                continue
+            actor.fighter.tick_buffs()
+            energy = self.energy[actor] + actor.speed
+            while energy >= ENERGY_PER_ACTION and actor.ai:
+                energy -= ENERGY_PER_ACTION
+                try:
+                    with profiler.timer("ai", type(actor.ai).__name__):
+                        actor.ai.perform()
+                except Impossible:
+                    pass
+            if not actor.isAlive or (actor not in nearby and actor.ai.is_idle()):
+                del self.energy[actor]
+            else:
+                self.energy[actor] = energy
 
 class GameMap:
     def __init__(self, engine, width, height, entities):
         self.width = width
         self.height = height
         self.engine = engine
-        self.entities = set(entities)
+        self.entities = set()
+        self._locations = {}
+        self._entities_at = {}
+        self._blockers_at = {}
+        self._blockers_version = 0
+        self._flow_target = None
+        self._flow_field = None
+        self._flow_field_key = None
+        self.actor_store = ActorStore()
+        self.scheduler = TurnScheduler()
+        self._terrain = None
+        self._terrain_dirty = []
+        self._fov_window = None
+        self._fov_key = None
+        for entity in entities:
+            self.add_entity(entity)
         self.tiles = np.full((width, height), fill_value=wall, order="F")
         self.visible = np.full((width, height), fill_value=False, order="F")
         self.explored = np.full((width, height), fill_value=False, order="F")
         self.downstairs_location = (0, 0)
+        self.upstairs_location = None
+        self.entry_location = None
+        #entities placed by generate_dungeon, in spawn order, so a rebuilt floor can be matched up with its delta
+        self.generated = None
+        #the template id each of them was spawned from, corpses get renamed so names won't do
+        self.generated_ids = None
 
     def in_bounds(self, x, y):
         return 0 <= x < self.width and 0 <= y < self.height
     
-    def render(self, console):
-        console.tiles_rgb[0:self.width, 0:self.height] = np.select(
-            condlist=[self.visible, self.explored], 
-            choicelist=[self.tiles["light"], self.tiles["dark"]], 
-            default=SHROUD
-        )
-        entites_sorted_for_rendering = sorted(self.entities, key=lambda x: x.render_order.value)
+    def invalidate_terrain(self):
+        #call after editing tiles, visible or explored outside of update_fov
+        self._terrain = None
+        self._terrain_dirty.clear()
+        self._fov_window = None
+        self._fov_key = None
+
+    def update_fov(self, x, y, radius):
+        #nothing to do if the viewer hasn't moved, otherwise only the (2*radius+1) window around it changes
+        key = (x, y, radius)
+        if key == self._fov_key:
+            return
+        if self._fov_key is None:
+            self.visible[:] = False
+        else:
+            x1, x2, y1, y2 = self.fov_bounds(*self._fov_key)
+            self.visible[x1:x2, y1:y2] = False
+        x1, x2, y1, y2 = self.fov_bounds(x, y, radius)
+        window = slice(x1, x2), slice(y1, y2)
+        self.visible[window] = compute_fov(self.tiles["transparent"][window], (x - x1, y - y1), radius=radius)
+        self.explored[window] |= self.visible[window]
+        self.mark_fov_window(x, y, radius)
+        self._fov_key = key
+
+    def fov_bounds(self, x, y, radius):
+        return max(0, x - radius), min(self.width, x + radius + 1), max(0, y - radius), min(self.height, y + radius + 1)
+
+    def mark_fov_window(self, x, y, radius):
+        window = self.fov_bounds(x, y, radius)
+        if self._terrain is not None:
+            if self._fov_window is not None:
+                self._terrain_dirty.append(self._fov_window)
+            self._terrain_dirty.append(window)
+            if len(self._terrain_dirty) > 64:
+                self.invalidate_terrain()
+        self._fov_window = window
+
+    @staticmethod
+    def composite_terrain(visible, explored, tiles):
+        return np.select(condlist=[visible, explored], choicelist=[tiles["light"], tiles["dark"]], default=SHROUD)
+
+    @property
+    def terrain(self):
+        if self._terrain is None:
+            self._terrain = self.composite_terrain(self.visible, self.explored, self.tiles)
+            self._terrain_dirty.clear()
+        for x1, x2, y1, y2 in self._terrain_dirty:
+            window = slice(x1, x2), slice(y1, y2)
+            self._terrain[window] = self.composite_terrain(self.visible[window], self.explored[window], self.tiles[window])
+        self._terrain_dirty.clear()
+        return self._terrain
+
+    @profiled("game_map.render")
+    def render(self, console, view_bounds=None):
+        x1, y1, x2, y2 = view_bounds or (0, 0, self.width, self.height)
+        console.tiles_rgb[0:x2 - x1, 0:y2 - y1] = self.terrain[x1:x2, y1:y2]
+        entites_sorted_for_rendering = sorted(self.entities_in_view(), key=lambda x: x.render_order.value)
         for entity in entites_sorted_for_rendering:
-            if self.visible[entity.x, entity.y]:
-                console.print(x=entity.x, y=entity.y, string=entity.char, fg=entity.color)
+            if self.visible[entity.x, entity.y] and x1 <= entity.x < x2 and y1 <= entity.y < y2:
+                console.print(x=entity.x - x1, y=entity.y - y1, string=entity.char, fg=entity.color)
+
+    def add_entity(self, entity):
+        self.entities.add(entity)
+        self._index(entity)
+        if isinstance(entity, Actor):
+            self.actor_store.add(entity)
+
+    def remove_entity(self, entity):
+        self.entities.discard(entity)
+        self._unindex(entity)
+        self.actor_store.remove(entity)
+        self.scheduler.discard(entity)
+
+    def move_entity(self, entity, x, y):
+        self._unindex(entity)
+        entity.x, entity.y = x, y
+        self._index(entity)
+        self.actor_store.move(entity, x, y)
+
+    def reindex_entity(self, entity):
+        #call after changing blocks_movement
+        self._unindex(entity)
+        self._index(entity)
+
+    def _index(self, entity):
+        self._unindex(entity)
+        location = (entity.x, entity.y)
+        self._locations[entity] = location
+        self._entities_at.setdefault(location, {})[entity] = None
+        if entity.blocks_movement and location not in self._blockers_at:
+            self._blockers_at[location] = entity
+            self._blockers_version += 1
+
+    def _unindex(self, entity):
+        location = self._locations.pop(entity, None)
+        if location is None:
+            return
+        entities_here = self._entities_at[location]
+        entities_here.pop(entity, None)
+        if not entities_here:
+            del self._entities_at[location]
+        if self._blockers_at.get(location) is entity:
+            del self._blockers_at[location]
+            self._blockers_version += 1
+            for other in entities_here:
+                if other.blocks_movement:
+                    self._blockers_at[location] = other
+                    break
+
+    def set_flow_target(self, x, y):
+        self._flow_target = (x, y, self._blockers_version)
 
-    def get_blocking_entity_at_location(self, loc_x, loc_y):
+    @property
+    def flow_field(self):
+        #shared pathfinder rooted at the flow target, rebuilt at most once per enemy turn
+        #only monsters that can see the target follow it, so it only covers a window around the target, not the whole floor
+        if self._flow_target is None:
+            return None
+        if self._flow_field is None or self._flow_field_key != self._flow_target:
+            target_x, target_y = self._flow_target[:2]
+            x0 = max(0, target_x - FLOW_RADIUS)
+            y0 = max(0, target_y - FLOW_RADIUS)
+            x1 = min(self.width, target_x + FLOW_RADIUS + 1)
+            y1 = min(self.height, target_y + FLOW_RADIUS + 1)
+            cost = np.array(self.tiles["walkable"][x0:x1, y0:y1], dtype=np.int8)
+            for x, y in self._blockers_at:
+                if x0 <= x < x1 and y0 <= y < y1 and cost[x - x0, y - y0]:
+                    cost[x - x0, y - y0] += 10
+            graph = tcod.path.SimpleGraph(cost=cost, cardinal=2, diagonal=3)
+            pathfinder = tcod.path.Pathfinder(graph)
+            pathfinder.add_root((target_x - x0, target_y - y0))
+            pathfinder.resolve()
+            self._flow_field = (pathfinder, x0, y0)
+            self._flow_field_key = self._flow_target
+        return self._flow_field
+
+    def flow_path_from(self, x, y):
+        #steps from (x, y) to the flow target, or None when the window around the target has no way there
+        flow_field = self.flow_field
+        if flow_field is None:
+            return None
+        pathfinder, x0, y0 = flow_field
+        width, height = pathfinder.distance.shape
+        if not (0 <= x - x0 < width and 0 <= y - y0 < height) or pathfinder.distance[x - x0, y - y0] == np.iinfo(pathfinder.distance.dtype).max:
+            return None
+        path = pathfinder.path_from((x - x0, y - y0))[1:].tolist()
+        return [(i[0] + x0, i[1] + y0) for i in path]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_flow_field"] = None
+        state["_flow_field_key"] = None
+        state["_terrain"] = None
+        state["_terrain_dirty"] = []
+        state["_fov_key"] = None
+        state["tiles"] = pack_tiles(self.tiles)
+        state["visible"] = pack_mask(self.visible)
+        state["explored"] = pack_mask(self.explored)
+        state["_packed"] = True
+        return state
+
+    def __setstate__(self, state):
+        if state.pop("_packed", False):
+            width, height = state["width"], state["height"]
+            state["tiles"] = unpack_tiles(*state["tiles"], width, height)
+            state["visible"] = unpack_mask(state["visible"], width, height)
+            state["explored"] = unpack_mask(state["explored"], width, height)
+        self.__dict__.update(state)
+        if "_locations" not in state:
+            #saves from before the spatial index, load_game rebuilds it once the entities are restored
+            self._locations = {}
+            self._entities_at = {}
+            self._blockers_at = {}
+            self._blockers_version = 0
+            self._flow_target = None
+            self._flow_field = None
+            self._flow_field_key = None
+            self.actor_store = ActorStore()
+        if "_terrain" not in state:
+            self._terrain = None
+            self._terrain_dirty = []
+            self._fov_window = None
+        if "scheduler" not in state:
+            self.scheduler = TurnScheduler()
+        if "_fov_key" not in state:
+            self._fov_key = None
+        if "generated" not in state:
+            self.upstairs_location = None
+            self.generated = None
+        if "generated_ids" not in state:
+            self.generated_ids = None
+
+    def archive_delta(self):
+        #what changed since generation: explored tiles, where each generated entity is now (or None once gone), and anything brought in
+        generated = set(self.generated or ())
+        states = None
+        if self.generated is not None:
+            states = []
+            for entity in self.generated:
+                if entity not in self.entities:
+                    states.append(None)
+                elif isinstance(entity, Actor):
+                    states.append((entity.x, entity.y, entity.fighter.hp))
+                else:
+                    states.append((entity.x, entity.y))
+        extras = [entity for tile in self._entities_at.values() for entity in tile if entity not in generated and entity is not self.engine.player]
+        buffer = io.BytesIO()
+        FloorPickler(buffer, self).dump({"explored": pack_mask(self.explored), "ids": self.generated_ids, "entities": states, "extras": extras})
+        return zlib.compress(buffer.getvalue())
+
+    def apply_delta(self, data):
+        #self must be a fresh build of the same floor
+        delta = FloorUnpickler(io.BytesIO(zlib.decompress(data)), self).load()
+        ids = delta.get("ids")
+        if ids is not None and ids != self.generated_ids:
+            raise Impossible("This floor was generated from different content than is loaded now.")
+        self.explored[:] = unpack_mask(delta["explored"], self.width, self.height)
+        states = delta["entities"]
+        if states is None:
+            #written by older builds for maps from pre-archive saves, extras holds everything but the terrain is a guess
+            states = [None] * len(self.generated)
+        for entity, state in zip(self.generated, states):
+            if state is None:
+                self.remove_entity(entity)
+                continue
+            if state[:2] != (entity.x, entity.y):
+                self.move_entity(entity, *state[:2])
+            if len(state) == 3 and isinstance(entity, Actor) and state[2] != entity.fighter.hp:
+                if state[2] == 0:
+                    entity.fighter.leave_corpse()
+                else:
+                    entity.fighter.hp = state[2]
+        for entity in delta["extras"]:
+            self.add_entity(entity)
+        self.invalidate_terrain()
+
+    def rebuild_index(self):
+        self._locations = {}
+        self._entities_at = {}
+        self._blockers_at = {}
+        self.actor_store = ActorStore()
         for entity in self.entities:
-            if entity.blocks_movement and entity.x == loc_x and entity.y == loc_y:
-                return entity
-        return None
+            self._index(entity)
+            if isinstance(entity, Actor):
+                self.actor_store.add(entity)
+
+    def entities_in_view(self):
+        #everything visible lies inside the last FOV window, so only those tiles need checking
+        if self._fov_window is None:
+            return self.entities
+        x1, x2, y1, y2 = self._fov_window
+        entities = []
+        for x, y in zip(*np.nonzero(self.visible[x1:x2, y1:y2])):
+            entities.extend(self.get_entities_at_location(int(x) + x1, int(y) + y1))
+        return entities
+
+    def get_entities_at_location(self, x, y):
+        return self._entities_at.get((x, y), ())
+
+    def get_blocking_entity_at_location(self, loc_x, loc_y):
+        return self._blockers_at.get((loc_x, loc_y))
     
     @property
     def gamemap(self):
@@ -827,20 +1998,41 @@ class GameMap:
 
     @property
     def actors(self):
-        yield from (entity for entity in self.entities if isinstance(entity, Actor) and entity.isAlive)
+        yield from self.actor_store.alive_actors()
 
     @property
     def items(self):
         yield from (entity for entity in self.entities if isinstance(entity, Item))
 
     def get_actor_at_location(self, x, y):
-        for actor in self.actors:
-            if actor.x == x and actor.y == y:
-                return actor
+        for entity in self.get_entities_at_location(x, y):
+            if isinstance(entity, Actor) and entity.isAlive:
+                return entity
         return None
     
+class FloorPickler(pickle.Pickler):
+    #pickles the entities of a floor without the floor itself, which they all point back to
+    def __init__(self, file, game_map):
+        super().__init__(file, protocol=5)
+        self.game_map = game_map
+
+    def persistent_id(self, obj):
+        return "floor" if obj is self.game_map else None
+
+class FloorUnpickler(pickle.Unpickler):
+    def __init__(self, file, game_map):
+        super().__init__(file)
+        self.game_map = game_map
+
+    def persistent_load(self, pid):
+        return self.game_map
+
 class GameWorld:
-    def __init__(self, *, engine, map_width, map_height, max_rooms, room_min_size, room_max_size, current_floor=0):
+    #floors left behind stay built in an LRU of floor_cache_size, older ones are kept as a delta against their seed
+    #maps from saves made before archiving were not built from the seed, so they are never archived and stay whole
+    floor_cache_size = 3
+
+    def __init__(self, *, engine, map_width, map_height, max_rooms, room_min_size, room_max_size, current_floor=0, seed=None, pregenerate=False):
         self.engine = engine
         self.map_width = map_width
         self.map_height = map_height
@@ -848,18 +2040,118 @@ class GameWorld:
         self.room_min_size = room_min_size
         self.room_max_size = room_max_size
         self.current_floor = current_floor
-
-    def generate_floor(self):
-        self.current_floor += 1
-        self.engine.game_map = generate_dungeon(
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.pregenerate = pregenerate
+        self._next_floor = None
+        self.ai_rng = self.stream(current_floor, "ai")
+        self.archive = {}
+        self.floor_cache = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_next_floor"] = None
+        state["archive"] = dict(self.archive)
+        state["floor_cache"] = OrderedDict()
+        for floor_number, game_map in self.floor_cache.items():
+            if game_map.generated is None:
+                state["floor_cache"][floor_number] = game_map
+            else:
+                state["archive"][floor_number] = game_map.archive_delta()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "seed" not in state:
+            self.seed = random.getrandbits(64)
+            self.pregenerate = False
+            self._next_floor = None
+        if "ai_rng" not in state:
+            self.ai_rng = self.stream(self.current_floor, "ai")
+        if "archive" not in state:
+            self.archive = {}
+            self.floor_cache = OrderedDict()
+
+    def stream(self, floor_number, subsystem):
+        #independent generator per (run seed, floor, subsystem): "layout", "spawns" or "ai"
+        return random.Random(f"{self.seed}:{floor_number}:{subsystem}")
+
+    def build_floor(self, floor_number):
+        return generate_dungeon(
             max_rooms=self.max_rooms,
             room_min_size=self.room_min_size,
             room_max_size=self.room_max_size,
             map_width=self.map_width,
             map_height=self.map_height,
             engine=self.engine,
+            floor_number=floor_number,
+            rng=self.stream(floor_number, "layout"),
+            spawn_rng=self.stream(floor_number, "spawns"),
             )
 
+    def generate_floor(self):
+        self.change_floor(self.current_floor + 1)
+
+    def change_floor(self, floor_number):
+        old_map = getattr(self.engine, "game_map", None)
+        game_map = self.load_floor(floor_number)
+        if floor_number > self.current_floor:
+            self.engine.player.place(*game_map.entry_location, game_map)
+        else:
+            self.engine.player.place(*game_map.downstairs_location, game_map)
+        if old_map is not None:
+            self.cache_floor(self.current_floor, old_map)
+        self.current_floor = floor_number
+        self.engine.game_map = game_map
+        self.ai_rng = self.stream(self.current_floor, "ai")
+        if self.pregenerate and not self.has_floor(self.current_floor + 1):
+            self.start_pregenerating(self.current_floor + 1)
+
+    def has_floor(self, floor_number):
+        return floor_number in self.floor_cache or floor_number in self.archive
+
+    def load_floor(self, floor_number):
+        game_map = self.floor_cache.pop(floor_number, None)
+        if game_map is not None:
+            return game_map
+        delta = self.archive.pop(floor_number, None)
+        if delta is None:
+            game_map = self.take_pregenerated_floor(floor_number)
+        if game_map is None:
+            game_map = self.build_floor(floor_number)
+        if delta is not None:
+            try:
+                game_map.apply_delta(delta)
+            except Impossible:
+                self.archive[floor_number] = delta
+                raise
+        return game_map
+
+    def cache_floor(self, floor_number, game_map):
+        self.floor_cache[floor_number] = game_map
+        archivable = [number for number, cached in self.floor_cache.items() if cached.generated is not None]
+        for old_number in archivable[:max(0, len(archivable) - self.floor_cache_size)]:
+            self.archive[old_number] = self.floor_cache.pop(old_number).archive_delta()
+
+    def start_pregenerating(self, floor_number):
+        result = {}
+
+        def build():
+            result["game_map"] = self.build_floor(floor_number)
+
+        thread = threading.Thread(target=build, name=f"pregenerate-floor-{floor_number}", daemon=True)
+        thread.start()
+        self._next_floor = (floor_number, thread, result)
+
+    def take_pregenerated_floor(self, floor_number):
+        if self._next_floor is None:
+            return None
+        pregenerated_floor, thread, result = self._next_floor
+        self._next_floor = None
+        if pregenerated_floor != floor_number:
+            return None
+        thread.join()
+        return result.get("game_map")
+
 class RectangularRoom:
     def __init__(self, x, y, width, height):
         self.x1 = x
@@ -889,82 +2181,140 @@ max_monsters_by_floor = [
     (6, 5),
 ]
 
-def get_max_value_for_floor(max_value_by_floor, floor):
-    current_value = 0
-    for floor_minimum, value in max_value_by_floor:
-        if floor_minimum > floor:
-            break
-        else:
-            current_value = value
-    return current_value
-
-def get_entities_at_random(weighted_chances_by_floor, number_of_entities, floor):
-    entity_weighted_chances = {}
-    for key, values in weighted_chances_by_floor.items():
-        if key > floor:
-            break
-        else:
-            for value in values:
-                entity = value[0]
-                weighted_chance = value[1]
-                entity_weighted_chances[entity] = weighted_chance
-    entities = list(entity_weighted_chances.keys())
-    entity_weighted_chance_values = list(entity_weighted_chances.values())
-    chosen_entities = random.choices(entities, weights=entity_weighted_chance_values, k=number_of_entities)
-    return chosen_entities
-
-def tunnel_between(start, end):
+class FloorValues:
+    #a floor-keyed list like max_items_by_floor, with the band found by bisect
+    def __init__(self, value_by_floor):
+        self.source = value_by_floor
+        self.compile()
+
+    def compile(self):
+        pairs = sorted(self.source)
+        self.floors = [floor_minimum for floor_minimum, value in pairs]
+        self.values = [value for floor_minimum, value in pairs]
+
+    def get(self, floor):
+        i = bisect.bisect_right(self.floors, floor)
+        return self.values[i - 1] if i else 0
+
+class SpawnTable:
+    #a floor-keyed chance table like enemy_chances, merged once into cumulative weights per floor band
+    def __init__(self, weighted_chances_by_floor):
+        self.source = weighted_chances_by_floor
+        self.compile()
+
+    def compile(self):
+        self.floors = []
+        self.bands = []
+        chances = {}
+        for floor_minimum in sorted(self.source):
+            for entity, weighted_chance in self.source[floor_minimum]:
+                chances[entity] = weighted_chance
+            cum_weights = list(itertools.accumulate(chances.values()))
+            self.floors.append(floor_minimum)
+            #a band whose weights are all zero spawns nothing
+            self.bands.append((list(chances), cum_weights) if cum_weights and cum_weights[-1] > 0 else ([], []))
+
+    def sample(self, number_of_entities, floor, rng=random):
+        i = bisect.bisect_right(self.floors, floor)
+        if not i or not number_of_entities:
+            return []
+        entities, cum_weights = self.bands[i - 1]
+        if not entities:
+            return []
+        #same draws as choices(weights=...) so seeded floors come out unchanged
+        return rng.choices(entities, cum_weights=cum_weights, k=number_of_entities)
+
+def carve_tunnel(tiles, start, end, tile, rng=random):
+    #L-shaped corridor between two points, carved as two slice assignments
     x1, y1 = start
     x2, y2 = end
-    if random.random() < 0.5:
+    if rng.random() < 0.5:
         corner_x, corner_y = x2, y1
     else:
         corner_x, corner_y = x1, y2
-    for x, y in tcod.los.bresenham((x1, y1), (corner_x, corner_y)).tolist():
-        yield x, y
-    for x, y in tcod.los.bresenham((corner_x, corner_y), (x2, y2)).tolist():
-        yield x, y
-
-def place_entities(room, dungeon, floor_number):
-    num_monsters = random.randint(0, get_max_value_for_floor(max_monsters_by_floor, floor_number))
-    num_items = random.randint(0, get_max_value_for_floor(max_items_by_floor, floor_number))
-    monsters = get_entities_at_random(enemy_chances, num_monsters, floor_number)
-    items = get_entities_at_random(item_chances, num_items, floor_number)
+    tiles[min(x1, corner_x):max(x1, corner_x) + 1, min(y1, corner_y):max(y1, corner_y) + 1] = tile
+    tiles[min(corner_x, x2):max(corner_x, x2) + 1, min(corner_y, y2):max(corner_y, y2) + 1] = tile
+
+class RoomGrid:
+    #buckets rooms by coarse grid cell so overlap tests only look at nearby rooms
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _cells_for(self, room):
+        for cx in range(room.x1 // self.cell_size, room.x2 // self.cell_size + 1):
+            for cy in range(room.y1 // self.cell_size, room.y2 // self.cell_size + 1):
+                yield cx, cy
+
+    def add(self, room):
+        for cell in self._cells_for(room):
+            self.cells.setdefault(cell, []).append(room)
+
+    def intersects(self, room):
+        for cell in self._cells_for(room):
+            for other in self.cells.get(cell, ()):
+                if room.intersects(other):
+                    return True
+        return False
+
+def place_entities(room, dungeon, floor_number, rng=random):
+    num_monsters = rng.randint(0, max_monsters.get(floor_number))
+    num_items = rng.randint(0, max_items.get(floor_number))
+    monsters = enemy_spawns.sample(num_monsters, floor_number, rng)
+    items = item_spawns.sample(num_items, floor_number, rng)
 
     for entity in monsters + items:
-        x = random.randint(room.x1 + 1, room.x2 - 1)
-        y = random.randint(room.y1 + 1, room.y2 - 1)
-
-        if not any(entity.x == x and entity.y == y for entity in dungeon.entities):
-            entity.spawn(dungeon, x, y)
-
-def generate_dungeon(max_rooms, room_min_size, room_max_size, map_width, map_height, engine):
-    player = engine.player
-    dungeon = GameMap(engine, map_width, map_height, entities=[player])
+        x = rng.randint(room.x1 + 1, room.x2 - 1)
+        y = rng.randint(room.y1 + 1, room.y2 - 1)
+
+        if (x, y) != dungeon.entry_location and not dungeon.get_entities_at_location(x, y):
+            dungeon.generated.append(entity.spawn(dungeon, x, y))
+            dungeon.generated_ids.append(template_id(entity))
+
+@profiled("generate_dungeon")
+def generate_dungeon(max_rooms, room_min_size, room_max_size, map_width, map_height, engine, floor_number=None, rng=random, spawn_rng=None):
+    #builds a floor without touching the player; the caller places them at dungeon.entry_location
+    if floor_number is None:
+        floor_number = engine.game_world.current_floor
+    if spawn_rng is None:
+        spawn_rng = rng
+    dungeon = GameMap(engine, map_width, map_height, entities=[])
+    dungeon.generated = []
+    dungeon.generated_ids = []
     rooms = []
+    room_grid = RoomGrid(cell_size=room_max_size + 1)
+    #rooms and corridors are all floor, so carve them into a mask and write the tiles once
+    carved = np.zeros((map_width, map_height), dtype=bool, order="F")
     center_of_last_room = (0, 0)
     for r in range(max_rooms):
-        room_width = random.randint(room_min_size, room_max_size)
-        room_height = random.randint(room_min_size, room_max_size)
-        x = random.randint(0, dungeon.width - room_width - 1)
-        y = random.randint(0, dungeon.height - room_height - 1)
+        room_width = rng.randint(room_min_size, room_max_size)
+        room_height = rng.randint(room_min_size, room_max_size)
+        x = rng.randint(0, dungeon.width - room_width - 1)
+        y = rng.randint(0, dungeon.height - room_height - 1)
         new_room = RectangularRoom(x, y, room_width, room_height)
-        if any(new_room.intersects(other_room) for other_room in rooms):
+        if room_grid.intersects(new_room):
             continue
-        dungeon.tiles[new_room.inner] = floor
+        carved[new_room.inner] = True
         if not rooms:
-            player.place(*new_room.center, dungeon)
+            dungeon.entry_location = new_room.center
         else:
-            for x, y in tunnel_between(rooms[-1].center, new_room.center):
-                dungeon.tiles[x, y] = floor
+            carve_tunnel(carved, rooms[-1].center, new_room.center, True, rng)
             center_of_last_room = new_room.center
-        place_entities(new_room, dungeon, engine.game_world.current_floor)
+        place_entities(new_room, dungeon, floor_number, spawn_rng)
+        rooms.append(new_room)
+        room_grid.add(new_room)
+    dungeon.tiles[carved] = floor
+    if rooms:
         dungeon.tiles[center_of_last_room] = down_stairs
         dungeon.downstairs_location = center_of_last_room
-        rooms.append(new_room)
+        if floor_number > 1:
+            dungeon.tiles[dungeon.entry_location] = up_stairs
+            dungeon.upstairs_location = dungeon.entry_location
     return dungeon
 
-class BaseComponent:
+class BaseComponent(Slotted):
+    __slots__ = ("parent",)
+
     @property
     def gamemap(self):
         return self.parent.gamemap
@@ -973,12 +2323,31 @@ class BaseComponent:
     def engine(self):
         return self.gamemap.engine
 
+class Buff(Slotted):
+    __slots__ = ("name", "turns", "power", "defense")
+
+    def __init__(self, name, turns, power=0, defense=0):
+        self.name = name
+        self.turns = turns
+        self.power = power
+        self.defense = defense
+
 class Fighter(BaseComponent):
+    __slots__ = ("max_hp", "_hp", "base_defense", "base_power", "buffs", "_totals")
+
     def __init__(self, hp, base_defense, base_power):
         self.max_hp = hp
         self._hp = hp
         self.base_defense = base_defense
         self.base_power = base_power
+        self.buffs = []
+        self._totals = None
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if "buffs" not in state:
+            self.buffs = []
+            self._totals = None
     
     @property
     def hp(self):
@@ -987,30 +2356,61 @@ class Fighter(BaseComponent):
     @hp.setter
     def hp(self, val):
         self._hp = max(0, min(val, self.max_hp))
+        self.parent.sync_actor_store()
         if self._hp == 0 and self.parent.ai:
             self.die()
 
+    @property
+    def totals(self):
+        #(power, defense) with equipment and buffs, cached until invalidate_stats
+        if self._totals is None:
+            power, defense = self.base_power, self.base_defense
+            if self.parent.equipment:
+                power_bonus, defense_bonus = self.parent.equipment.bonuses
+                power += power_bonus
+                defense += defense_bonus
+            for buff in self.buffs:
+                power += buff.power
+                defense += buff.defense
+            self._totals = power, defense
+        return self._totals
+
     @property
     def defense(self):
-        return self.base_defense + self.defense_bonus
+        return self.totals[1]
     
     @property
     def power(self):
-        return self.base_power + self.power_bonus
+        return self.totals[0]
 
     @property
     def defense_bonus(self):
-        if self.parent.equipment:
-            return self.parent.equipment.defense_bonus
-        else:
-            return 0
+        return self.defense - self.base_defense
 
     @property
     def power_bonus(self):
-        if self.parent.equipment:
-            return self.parent.equipment.power_bonus
-        else:
-            return 0
+        return self.power - self.base_power
+
+    def invalidate_stats(self):
+        self._totals = None
+        self.parent.sync_actor_store()
+
+    def add_buff(self, buff):
+        self.buffs.append(buff)
+        self.invalidate_stats()
+
+    def tick_buffs(self):
+        if not self.buffs:
+            return
+        for buff in self.buffs:
+            buff.turns -= 1
+        expired = [buff for buff in self.buffs if buff.turns <= 0]
+        if expired:
+            self.buffs = [buff for buff in self.buffs if buff.turns > 0]
+            self.invalidate_stats()
+            if self.parent is self.engine.player:
+                for buff in expired:
+                    self.engine.message_log.add_message(f"The {buff.name} wears off.")
 
     def die(self):
         if self.engine.player is self.parent:
@@ -1020,16 +2420,22 @@ class Fighter(BaseComponent):
             death_message = f"{self.parent.name} is dead!"
             death_message_color = enemy_die
         
+        self.leave_corpse()
+
+        self.engine.message_log.add_message(death_message, death_message_color)
+
+        self.engine.player.level.add_xp(self.parent.level.xp_given)
+
+    def leave_corpse(self):
+        self._hp = 0
         self.parent.char = "%"
         self.parent.color = (190, 0, 0)
         self.parent.blocks_movement = False
+        self.gamemap.reindex_entity(self.parent)
         self.parent.ai = None
         self.parent.name = f"remains of {self.parent.name}"
         self.parent.render_order = RenderOrder.CORPSE
-
-        self.engine.message_log.add_message(death_message, death_message_color)
-
-        self.engine.player.level.add_xp(self.parent.level.xp_given)
+        self.parent.sync_actor_store()
 
     def heal(self, amount):
         if self.hp == self.max_hp:
@@ -1045,6 +2451,8 @@ class Fighter(BaseComponent):
         self.hp -= amount
 
 class Inventory(BaseComponent):
+    __slots__ = ("capacity", "items")
+
     def __init__(self, capacity):
         self.capacity = capacity
         self.items = []
@@ -1055,6 +2463,8 @@ class Inventory(BaseComponent):
         self.engine.message_log.add_message(f"You dropped [{item.name}]")
 
 class Consumable(BaseComponent):
+    __slots__ = ()
+
     def get_action(self, consumer):
         return ItemAction(consumer, self.parent)
     def activate(self, action):
@@ -1067,6 +2477,8 @@ class Consumable(BaseComponent):
 
     
 class HealingConsumable(Consumable):
+    __slots__ = ("amount",)
+
     def __init__(self, amount):
         self.amount = amount
     def activate(self, action):
@@ -1078,20 +2490,31 @@ class HealingConsumable(Consumable):
         else:
             raise Impossible(f"Your health is already full.")
 
+class BuffConsumable(Consumable):
+    __slots__ = ("name", "turns", "power", "defense")
+
+    def __init__(self, name, turns, power=0, defense=0):
+        self.name = name
+        self.turns = turns
+        self.power = power
+        self.defense = defense
+    def activate(self, action):
+        consumer = action.entity
+        consumer.fighter.add_buff(Buff(self.name, self.turns, power=self.power, defense=self.defense))
+        self.engine.message_log.add_message(f"You consume the {self.parent.name}, and feel the {self.name} take hold.", health_recovered)
+        self.consume()
+
 class ArcaneDamageConsumable(Consumable):
+    __slots__ = ("damage", "maximum_range")
+
     def __init__(self, damage, maximum_range):
         self.damage = damage
         self.maximum_range = maximum_range
 
     def activate(self, action):
         consumer = action.entity
-        target = None
-        closest_distance = self.maximum_range + 1.0
-        for actor in self.engine.game_map.actors:
-            if actor is not consumer and self.parent.gamemap.visible[actor.x, actor.y]:
-                distance = consumer.distance(actor.x, actor.y)
-                if distance < closest_distance:
-                    target, closest_distance = actor, distance
+        game_map = self.engine.game_map
+        target = game_map.actor_store.nearest(consumer.x, consumer.y, self.maximum_range + 1, visible=game_map.visible, exclude=consumer)
         if target:
             self.engine.message_log.add_message(f"A blast of concentrated energy strikes [{target.name}], dealing {self.damage} damage!")
             target.fighter.take_damage(self.damage)
@@ -1100,6 +2523,8 @@ class ArcaneDamageConsumable(Consumable):
             raise Impossible("No enemy is close enough to strike.")
         
 class ConfusionConsumable(Consumable):
+    __slots__ = ("number_of_turns",)
+
     def __init__(self, number_of_turns):
         self.number_of_turns = number_of_turns
 
@@ -1121,6 +2546,8 @@ class ConfusionConsumable(Consumable):
         self.consume()
         
 class FireballConsumable(Consumable):
+    __slots__ = ("damage", "radius")
+
     def __init__(self, damage, radius):
         self.damage = damage
         self.radius = radius
@@ -1134,16 +2561,17 @@ class FireballConsumable(Consumable):
         if not self.engine.game_map.visible[target_xy]:
             raise Impossible("You cannot target an area you cannot see.")
         targets_hit = False
-        for actor in self.engine.game_map.actors:
-            if actor.distance(*target_xy) <= self.radius:
-                self.engine.message_log.add_message(f"[{actor.name}] is enveloped in a fiery blaze, taking {self.damage} damage.")
-                actor.fighter.take_damage(self.damage)
-                targets_hit = True
+        for actor in self.engine.game_map.actor_store.in_radius(*target_xy, self.radius):
+            self.engine.message_log.add_message(f"[{actor.name}] is enveloped in a fiery blaze, taking {self.damage} damage.")
+            actor.fighter.take_damage(self.damage)
+            targets_hit = True
         if not targets_hit:
             raise Impossible("There are no targets in the radius.")
         self.consume()
 
 class Level(BaseComponent):
+    __slots__ = ("current_level", "current_xp", "level_up_base", "level_up_factor", "xp_given")
+
     def __init__(self, current_level=1, current_xp=0, level_up_base=0, level_up_factor=150, xp_given=0):
         self.current_level = current_level
         self.current_xp = current_xp
@@ -1179,65 +2607,100 @@ class Level(BaseComponent):
 
     def increase_power(self, amount=1):
         self.parent.fighter.base_power += amount
+        self.parent.fighter.invalidate_stats()
         self.engine.message_log.add_message("Your body feels stronger.")
         self.increase_level()
     
     def increase_defense(self, amount=1):
         self.parent.fighter.base_defense += amount
+        self.parent.fighter.invalidate_stats()
         self.engine.message_log.add_message("You feel less vulnerable.")
         self.increase_level()
 
 class EquipmentType(Enum):
     WEAPON = auto()
     ARMOR = auto()
+    SHIELD = auto()
+    HELMET = auto()
+    RING = auto()
+    AMULET = auto()
 
 class Equippable(BaseComponent):
+    __slots__ = ("equipment_type", "power_bonus", "defense_bonus")
+
     def __init__(self, equipment_type, power_bonus=0, defense_bonus=0):
         self.equipment_type = equipment_type
         self.power_bonus = power_bonus
         self.defense_bonus = defense_bonus
 
 class Dagger(Equippable):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(equipment_type=EquipmentType.WEAPON, power_bonus=2)
 
 class Sword(Equippable):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(equipment_type=EquipmentType.WEAPON, power_bonus=4)
 
 class LeatherArmor(Equippable):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(equipment_type=EquipmentType.ARMOR, defense_bonus=0)
 
 class Chainmail(Equippable):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(equipment_type=EquipmentType.ARMOR, defense_bonus=2)
 
 class Equipment(BaseComponent):
+    #one item per EquipmentType, with the summed bonuses cached until a slot changes
+    __slots__ = ("slots", "_bonuses")
+
     def __init__(self, weapon=None, armor=None):
-        self.weapon = weapon
-        self.armor = armor
+        self.slots = {}
+        if weapon is not None:
+            self.slots[EquipmentType.WEAPON] = weapon
+        if armor is not None:
+            self.slots[EquipmentType.ARMOR] = armor
+        self._bonuses = None
+
+    def __setstate__(self, state):
+        if "slots" not in state:
+            weapon, armor = state.pop("weapon", None), state.pop("armor", None)
+            state["slots"] = {slot: item for slot, item in ((EquipmentType.WEAPON, weapon), (EquipmentType.ARMOR, armor)) if item is not None}
+            state["_bonuses"] = None
+        super().__setstate__(state)
+
+    @property
+    def bonuses(self):
+        if self._bonuses is None:
+            power = defense = 0
+            for item in self.slots.values():
+                if item.equippable is not None:
+                    power += item.equippable.power_bonus
+                    defense += item.equippable.defense_bonus
+            self._bonuses = power, defense
+        return self._bonuses
 
     @property
     def defense_bonus(self):
-        bonus = 0
-        if self.weapon is not None and self.weapon.equippable is not None:
-            bonus += self.weapon.equippable.defense_bonus
-        if self.armor is not None and self.armor.equippable is not None:
-            bonus += self.armor.equippable.defense_bonus
-        return bonus
+        return self.bonuses[1]
     
     @property
     def power_bonus(self):
-        bonus = 0
-        if self.weapon is not None and self.weapon.equippable is not None:
-            bonus += self.weapon.equippable.power_bonus
-        if self.armor is not None and self.armor.equippable is not None:
-            bonus += self.armor.equippable.power_bonus
-        return bonus
+        return self.bonuses[0]
+
+    def invalidate(self):
+        self._bonuses = None
+        self.parent.fighter.invalidate_stats()
     
     def item_is_equipped(self, item):
-        return self.weapon == item or self.armor == item
+        return item.equippable is not None and self.slots.get(item.equippable.equipment_type) is item
     
     def unequip_message(self, item_name):
         self.parent.gamemap.engine.message_log.add_message(f"You remove the {item_name}.")
@@ -1246,32 +2709,34 @@ class Equipment(BaseComponent):
         self.parent.gamemap.engine.message_log.add_message(f"You equip the {item_name}.")
 
     def equip_to_slot(self, slot, item, add_message):
-        current_item = getattr(self, slot)
-        if current_item is not None:
+        if slot in self.slots:
             self.unequip_from_slot(slot, add_message)
-        setattr(self, slot, item)
+        self.slots[slot] = item
+        self.invalidate()
         if add_message:
             self.equip_message(item.name)
     
     def unequip_from_slot(self, slot, add_message):
-        current_item = getattr(self, slot)
+        current_item = self.slots.pop(slot)
         if add_message:
             self.unequip_message(current_item.name)
-        setattr(self, slot, None)
+        self.invalidate()
 
     def toggle_equip(self, equippable_item, add_message=True):
-        if (equippable_item.equippable and equippable_item.equippable.equipment_type == EquipmentType.WEAPON):
-            slot = "weapon"
-        else:
-            slot = "armor"
-        if getattr(self, slot) == equippable_item:
+        slot = equippable_item.equippable.equipment_type
+        if self.slots.get(slot) is equippable_item:
             self.unequip_from_slot(slot, add_message)
         else:
             self.equip_to_slot(slot, equippable_item, add_message)
 
 class BaseAI(Action):
+    __slots__ = ()
+
     def perform(self):
         raise NotImplementedError()
+    def is_idle(self):
+        #idle AIs out of the player's range are put to sleep by the TurnScheduler
+        return False
     def get_path_to(self, dest_x, dest_y):
         cost = np.array(self.entity.gamemap.tiles["walkable"], dtype = np.int8)
         for entity in self.entity.gamemap.entities:
@@ -1284,7 +2749,15 @@ class BaseAI(Action):
 
         return [(i[0], i[1]) for i in path]
 
+    def get_path_to_flow_target(self):
+        path = self.entity.gamemap.flow_path_from(self.entity.x, self.entity.y)
+        if path is None:
+            return self.get_path_to(self.engine.player.x, self.engine.player.y)
+        return path
+
 class HostileEnemy(BaseAI):
+    __slots__ = ("path",)
+
     def __init__(self, entity):
         super().__init__(entity)
         self.path = []
@@ -1297,13 +2770,18 @@ class HostileEnemy(BaseAI):
         if self.engine.game_map.visible[self.entity.x, self.entity.y]:
             if dist <= 1:
                 return MeleeAction(self.entity, dx, dy).perform()
-            self.path = self.get_path_to(target.x, target.y)
+            self.path = self.get_path_to_flow_target()
         if self.path:
             dest_x, dest_y = self.path.pop(0)
             return MovementAction(self.entity, dest_x - self.entity.x, dest_y - self.entity.y).perform()
         return WaitAction(self.entity).perform()
+
+    def is_idle(self):
+        return not self.path
     
 class ConfusedEnemy(BaseAI):
+    __slots__ = ("previous_ai", "turns_remaining")
+
     def __init__(self, entity, previous_ai, turns_remaining):
         super().__init__(entity)
         self.previous_ai = previous_ai
@@ -1314,7 +2792,7 @@ class ConfusedEnemy(BaseAI):
             self.engine.message_log.add_message(f"[{self.entity.name}] is no longer confused.")
             self.entity.ai = self.previous_ai
         else:
-            direction_x, direction_y = random.choice([
+            direction_x, direction_y = self.engine.game_world.ai_rng.choice([
                 (-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)
             ])
             self.turns_remaining -= 1
@@ -1350,7 +2828,7 @@ menu_text = white
 def get_names_at_location(x, y, game_map):
     if not game_map.in_bounds(x, y) or not game_map.visible[x, y]:
         return ""
-    names = ", ".join(entity.name for entity in game_map.entities if entity.x == x and entity.y == y)
+    names = ", ".join(entity.name for entity in game_map.get_entities_at_location(x, y))
     return names.capitalize()
 
 def render_bar(console, curr_value, max_value, total_width):
@@ -1361,7 +2839,7 @@ def render_bar(console, curr_value, max_value, total_width):
     console.print(x=1, y=45, string=f"HP: {curr_value}/{max_value}", fg=bar_text)
 
 def render_names_at_mouse_loc(console, x, y, engine):
-    mouse_x, mouse_y = engine.mouse_loc
+    mouse_x, mouse_y = engine.mouse_location
     names_at_mouse_location = get_names_at_location(x=mouse_x, y=mouse_y, game_map=engine.game_map)
     console.print(x=x, y=y, string=names_at_mouse_location)
 
@@ -1369,29 +2847,69 @@ def render_dungeon_level(console, dungeon_level, location):
     x, y = location
     console.print(x=x, y=y, string=f"Dungeon level: {dungeon_level}")
 
-class Message:
+class Message(Slotted):
+    __slots__ = ("plain_text", "fg", "count", "_wrapped")
+
     def __init__(self, text, fg):
         self.plain_text = text
         self.fg = fg
         self.count = 1
+        self._wrapped = None
+
     @property
     def full_text(self):
         if self.count > 1:
-            return f"{self.plain_text} (x{self.count}"
+            return f"{self.plain_text} (x{self.count})"
         return self.plain_text
-    
+
+    def wrapped(self, width):
+        #wrapped lines are cached per width and go stale when the message stacks again
+        if self._wrapped is None:
+            self._wrapped = {}
+        cached = self._wrapped.get(width)
+        if cached is None or cached[0] != self.count:
+            cached = self._wrapped[width] = (self.count, list(MessageLog.wrap(self.full_text, width)))
+        return cached[1]
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state["_wrapped"]
+        return state
+
+    def __setstate__(self, state):
+        state.pop("_wrapped", None)
+        super().__setstate__(state)
+        self._wrapped = None
+
 class MessageLog:
-    def __init__(self):
-        self.messages = []
+    def __init__(self, capacity=1000, spill_path=None):
+        #keeps the newest messages in memory, older ones are dropped or appended to spill_path
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self.messages = deque(maxlen=capacity)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not isinstance(self.messages, deque):
+            self.capacity = max(1000, len(self.messages))
+            self.spill_path = None
+            self.messages = deque(self.messages, maxlen=self.capacity)
 
     def add_message(self, text, fg=white, *, canStack=True):
         if canStack and self.messages and text == self.messages[-1].plain_text:
             self.messages[-1].count += 1
         else:
+            if len(self.messages) == self.capacity and self.spill_path:
+                with open(self.spill_path, "a", encoding="utf-8") as f:
+                    f.write(self.messages[0].full_text + "\n")
             self.messages.append(Message(text, fg))
+        screen_dirty.mark("log")
 
-    def render(self, console, x, y, width, height):
-        self.render_messages(console, x, y, width, height, self.messages)
+    @profiled("message_log.render")
+    def render(self, console, x, y, width, height, end=None):
+        if end is None:
+            end = len(self.messages) - 1
+        self.render_messages_newest_first(console, x, y, width, height, (self.messages[i] for i in range(end, -1, -1)))
 
     @staticmethod
     def wrap(string, width):
@@ -1400,9 +2918,13 @@ class MessageLog:
     
     @classmethod
     def render_messages(cls, console, x, y, width, height, messages):
+        cls.render_messages_newest_first(console, x, y, width, height, reversed(messages))
+
+    @staticmethod
+    def render_messages_newest_first(console, x, y, width, height, messages):
         y_offset = height - 1
-        for message in reversed(messages):
-            for line in reversed(list(cls.wrap(message.full_text, width))):
+        for message in messages:
+            for line in reversed(message.wrapped(width)):
                 console.print(x=x, y=y + y_offset, string=line, fg=message.fg)
                 y_offset -= 1
                 if y_offset < 0:
@@ -1440,5 +2962,312 @@ enemy_chances = {
     7: [(shadow_knight, 60)],
 }
 
+#compiled once here; call compile_spawn_tables() after editing any of the tables above
+max_items = FloorValues(max_items_by_floor)
+max_monsters = FloorValues(max_monsters_by_floor)
+item_spawns = SpawnTable(item_chances)
+enemy_spawns = SpawnTable(enemy_chances)
+
+def compile_spawn_tables():
+    for table in (max_items, max_monsters, item_spawns, enemy_spawns):
+        table.compile()
+
+def spawn_tables_digest():
+    import hashlib
+    tables = [sorted(max_items_by_floor), sorted(max_monsters_by_floor)]
+    for chances in (enemy_chances, item_chances):
+        tables.append([(floor, [(template_id(template), weight) for template, weight in chances[floor]]) for floor in sorted(chances)])
+    return hashlib.sha1(json.dumps(tables).encode()).hexdigest()
+
+#templates that content packs can refer to by id
+TEMPLATES = {
+    "vampire": vampire,
+    "shadow_knight": shadow_knight,
+    "health_potion": health_potion,
+    "arcane_blast": arcane_blast,
+    "zoink": zoink,
+    "fireball": fireball,
+    "dagger": dagger,
+    "sword": sword,
+    "leather_armor": leather_armor,
+    "chainmail": chainmail,
+}
+TEMPLATE_IDS = {id(template): key for key, template in TEMPLATES.items()}
+
+def template_id(template):
+    return TEMPLATE_IDS.get(id(template), template.name)
+
+class ContentError(Exception):
+    '''a content pack is malformed or refers to something that does not exist'''
+
+CONTENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "packs")
+CONTENT_CACHE = ".content_cache"
+CONTENT_CACHE_VERSION = 2
+LOADED_PACKS = []
+PENDING_PACKS = []
+
+REQUIRED = object()
+FIELD_KINDS = {str: "text", int: "a whole number", list: "a list", dict: "a table"}
+ACTOR_FIELDS = {
+    "name": (str, REQUIRED),
+    "char": (str, REQUIRED),
+    "color": (list, [255, 255, 255]),
+    "hp": (int, REQUIRED),
+    "power": (int, REQUIRED),
+    "defense": (int, 0),
+    "xp": (int, 0),
+    "speed": (int, 100),
+}
+ITEM_FIELDS = {
+    "name": (str, REQUIRED),
+    "char": (str, REQUIRED),
+    "color": (list, [255, 255, 255]),
+    "consumable": (dict, None),
+    "equippable": (dict, None),
+}
+EQUIPPABLE_FIELDS = {
+    "slot": (str, REQUIRED),
+    "power": (int, 0),
+    "defense": (int, 0),
+}
+CONSUMABLE_TYPES = {
+    "healing": (HealingConsumable, {"amount": (int, REQUIRED)}),
+    "buff": (BuffConsumable, {"name": (str, REQUIRED), "turns": (int, REQUIRED), "power": (int, 0), "defense": (int, 0)}),
+    "arcane_damage": (ArcaneDamageConsumable, {"damage": (int, REQUIRED), "maximum_range": (int, REQUIRED)}),
+    "confusion": (ConfusionConsumable, {"number_of_turns": (int, REQUIRED)}),
+    "fireball": (FireballConsumable, {"damage": (int, REQUIRED), "radius": (int, REQUIRED)}),
+}
+
+def check_fields(where, data, fields, ignore=()):
+    if not isinstance(data, dict):
+        raise ContentError(f"{where}: expected a table of fields")
+    unknown = set(data) - set(fields) - set(ignore)
+    if unknown:
+        raise ContentError(f"{where}: unknown field '{sorted(unknown)[0]}'")
+    checked = {}
+    for key, (kind, default) in fields.items():
+        if key not in data:
+            if default is REQUIRED:
+                raise ContentError(f"{where}: missing '{key}'")
+            checked[key] = default
+            continue
+        value = data[key]
+        if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            raise ContentError(f"{where}.{key}: expected {FIELD_KINDS[kind]}")
+        if kind is int and value < 0:
+            raise ContentError(f"{where}.{key}: must not be negative")
+        checked[key] = value
+    return checked
+
+def check_look(where, fields):
+    if len(fields["char"]) != 1:
+        raise ContentError(f"{where}.char: must be a single character")
+    color = fields["color"]
+    if len(color) != 3 or not all(isinstance(c, int) and not isinstance(c, bool) and 0 <= c <= 255 for c in color):
+        raise ContentError(f"{where}.color: must be three integers from 0 to 255")
+    fields["color"] = tuple(color)
+
+def check_floors(where, data, check_value):
+    #{"3": ...} -> [(3, ...)], the floor keys are strings in both JSON and TOML
+    if not isinstance(data, dict):
+        raise ContentError(f"{where}: expected a table keyed by floor")
+    floors = []
+    for floor, value in data.items():
+        #isdigit() lets through superscripts like "¹" that int() then rejects
+        if not (floor.isascii() and floor.isdecimal()):
+            raise ContentError(f"{where}: floor '{floor}' is not a whole number")
+        floors.append((int(floor), check_value(f"{where}.{floor}", value)))
+    return floors
+
+def check_count(where, value):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ContentError(f"{where}: expected a whole number")
+    return value
+
+def check_weights(where, value):
+    if not isinstance(value, dict):
+        raise ContentError(f"{where}: expected a table of id = weight")
+    for template_id, weight in value.items():
+        check_count(f"{where}.{template_id}", weight)
+    return value
+
+def compile_pack(name, data):
+    #validates one parsed pack and reduces it to plain data that pickles without any game classes
+    if not isinstance(data, dict):
+        raise ContentError(f"{name}: expected a table at the top level")
+    check_fields(f"{name}: pack", data, {"actors": (dict, {}), "items": (dict, {}), "spawns": (dict, {}), "max_monsters": (dict, {}), "max_items": (dict, {})})
+    actors = {}
+    for template_id, fields in data.get("actors", {}).items():
+        where = f"{name}: actors.{template_id}"
+        fields = check_fields(where, fields, ACTOR_FIELDS)
+        check_look(where, fields)
+        if fields["hp"] == 0 or fields["speed"] == 0:
+            raise ContentError(f"{where}: hp and speed must be positive")
+        actors[template_id] = fields
+    items = {}
+    for template_id, fields in data.get("items", {}).items():
+        where = f"{name}: items.{template_id}"
+        fields = check_fields(where, fields, ITEM_FIELDS)
+        check_look(where, fields)
+        if fields["consumable"] is not None and fields["equippable"] is not None:
+            raise ContentError(f"{where}: an item is either a consumable or an equippable, not both")
+        if fields["consumable"] is not None:
+            kind = fields["consumable"].get("type")
+            if not isinstance(kind, str) or kind not in CONSUMABLE_TYPES:
+                raise ContentError(f"{where}.consumable.type: expected one of {', '.join(CONSUMABLE_TYPES)}")
+            fields["consumable"] = (kind, check_fields(f"{where}.consumable", fields["consumable"], CONSUMABLE_TYPES[kind][1], ignore=("type",)))
+        if fields["equippable"] is not None:
+            equippable = check_fields(f"{where}.equippable", fields["equippable"], EQUIPPABLE_FIELDS)
+            if equippable["slot"].upper() not in EquipmentType.__members__:
+                raise ContentError(f"{where}.equippable.slot: expected one of {', '.join(slot.lower() for slot in EquipmentType.__members__)}")
+            fields["equippable"] = equippable
+        items[template_id] = fields
+    spawns = check_fields(f"{name}: spawns", data.get("spawns", {}), {"enemies": (dict, {}), "items": (dict, {})})
+    return {
+        "actors": actors,
+        "items": items,
+        "enemy_spawns": check_floors(f"{name}: spawns.enemies", spawns["enemies"], check_weights),
+        "item_spawns": check_floors(f"{name}: spawns.items", spawns["items"], check_weights),
+        "max_monsters": check_floors(f"{name}: max_monsters", data.get("max_monsters", {}), check_count),
+        "max_items": check_floors(f"{name}: max_items", data.get("max_items", {}), check_count),
+    }
+
+def read_pack(path):
+    name = os.path.basename(path)
+    try:
+        with open(path, "rb") as f:
+            if name.endswith(".toml"):
+                try:
+                    import tomllib
+                except ImportError:
+                    raise ContentError(f"{name}: TOML packs need Python 3.11 or newer") from None
+                data = tomllib.load(f)
+            else:
+                data = json.load(f)
+    except ValueError as exc:
+        raise ContentError(f"{name}: {exc}") from None
+    return name, compile_pack(name, data)
+
+def build_actor(fields):
+    return Actor(char=fields["char"], color=fields["color"], name=fields["name"], ai_cls=HostileEnemy, equipment=Equipment(), fighter=Fighter(hp=fields["hp"], base_defense=fields["defense"], base_power=fields["power"]), inventory=Inventory(capacity=0), level=Level(xp_given=fields["xp"]), speed=fields["speed"])
+
+def build_item(fields):
+    consumable = equippable = None
+    if fields["consumable"] is not None:
+        kind, params = fields["consumable"]
+        consumable = CONSUMABLE_TYPES[kind][0](**params)
+    if fields["equippable"] is not None:
+        params = fields["equippable"]
+        equippable = Equippable(EquipmentType[params["slot"].upper()], power_bonus=params["power"], defense_bonus=params["defense"])
+    return Item(char=fields["char"], color=fields["color"], name=fields["name"], consumable=consumable, equippable=equippable)
+
+def set_chances(chances, floor, weights):
+    #a template already listed for this floor gets its weight replaced, new ones are appended
+    entries = chances.setdefault(floor, [])
+    index = {entity: i for i, (entity, _) in enumerate(entries)}
+    for template, weight in weights:
+        if template in index:
+            entries[index[template]] = (template, weight)
+        else:
+            index[template] = len(entries)
+            entries.append((template, weight))
+
+def set_floor_value(value_by_floor, floor, value):
+    for i, (floor_minimum, _) in enumerate(value_by_floor):
+        if floor_minimum == floor:
+            value_by_floor[i] = (floor, value)
+            return
+    value_by_floor.append((floor, value))
+
+def resolve_packs(packs):
+    #builds every template and looks up every spawn id without touching the live tables, so a bad pack changes nothing
+    templates = dict(TEMPLATES)
+    added = {}
+    spawns = []
+    for name, pack in packs:
+        for builder, definitions in ((build_actor, pack["actors"]), (build_item, pack["items"])):
+            for template_id, fields in definitions.items():
+                if template_id in templates:
+                    raise ContentError(f"{name}: '{template_id}' is already defined")
+                templates[template_id] = added[template_id] = builder(fields)
+        for key, chances, kind in (("enemy_spawns", enemy_chances, Actor), ("item_spawns", item_chances, Item)):
+            for floor, weights in pack[key]:
+                resolved = []
+                for template_id, weight in weights.items():
+                    template = templates.get(template_id)
+                    if not isinstance(template, kind):
+                        raise ContentError(f"{name}: no {kind.__name__.lower()} called '{template_id}' to spawn on floor {floor}")
+                    resolved.append((template, weight))
+                spawns.append((chances, floor, resolved))
+    return added, spawns
+
+def apply_packs(packs):
+    added, spawns = resolve_packs(packs)
+    TEMPLATES.update(added)
+    TEMPLATE_IDS.update((id(template), key) for key, template in added.items())
+    for chances, floor, resolved in spawns:
+        set_chances(chances, floor, resolved)
+    for name, pack in packs:
+        for floor, value in pack["max_monsters"]:
+            set_floor_value(max_monsters_by_floor, floor, value)
+        for floor, value in pack["max_items"]:
+            set_floor_value(max_items_by_floor, floor, value)
+    compile_spawn_tables()
+
+def load_pending_packs():
+    #a failed directory stays pending, so it fails again rather than quietly starting without it
+    while PENDING_PACKS:
+        load_content_packs(PENDING_PACKS[0])
+        PENDING_PACKS.pop(0)
+
+def load_content_packs(directory=CONTENT_DIR):
+    #applies every *.json and *.toml pack in directory in name order, reusing the compiled cache while no file has changed
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory) if name.endswith((".json", ".toml")))
+    key = [CONTENT_CACHE_VERSION]
+    for name in names:
+        st = os.stat(os.path.join(directory, name))
+        key.append((name, st.st_mtime_ns, st.st_size))
+    cache_path = os.path.join(directory, CONTENT_CACHE)
+    packs = None
+    try:
+        with open(cache_path, "rb") as f:
+            cached_key, cached_packs = pickle.load(f)
+        if cached_key == key:
+            packs = cached_packs
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+    if packs is None:
+        packs = [read_pack(os.path.join(directory, name)) for name in names]
+        try:
+            with open(cache_path + ".tmp", "wb") as f:
+                pickle.dump((key, packs), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError:
+            pass
+    apply_packs(packs)
+    LOADED_PACKS.extend(names)
+    return names
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    profiler.enabled = args.profile
+    if args.startup_check:
+        sys.exit(check_startup(offscreen_startup() if args.headless else main(startup_check=True)))
+    if args.replay or args.headless:
+        try:
+            load_content_packs(args.packs)
+        except ContentError as exc:
+            sys.exit(f"Could not load content packs: {exc}")
+    else:
+        #the window loads them when a game starts, so the menu doesn't wait on them
+        PENDING_PACKS.append(args.packs)
+    if args.replay:
+        replay_main(args)
+    elif args.headless:
+        headless_main(args)
+    else:
+        main(record_path=args.record)
+    if args.profile and (args.replay or args.headless):
+        print(profiler.report())